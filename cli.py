@@ -0,0 +1,315 @@
+import argparse
+import json
+import os
+import sys
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Iterator, TextIO
+
+import numpy as np
+
+import grammars
+import lossy
+from language import Language
+from lossy import MODELS, MODEL_PARAMETERS, get_parameters
+
+# the model used by the current (worker) process, set up by `_init_worker`
+_model: lossy.LossyContextModel | None = None
+_model_name: str | None = None
+
+
+def read_items(filename: str) -> Iterator[tuple[int, dict]]:
+    """
+    Stream items from a TSV or JSONL file.
+
+    A JSONL file holds one JSON object per line with the key `sequence`
+    (either a list of words or a space-separated string) and optionally
+    the model parameters (e.g. `delta` and `nu`) and an `id`.
+
+    A TSV file starts with a header naming the columns, one of which has to
+    be `sequence` with the words separated by spaces.
+
+    Args
+    ----
+    filename : str
+        The file to read from. Files ending in `.jsonl` or `.json` are read as
+        JSONL, everything else as TSV.
+
+    Returns
+    -------
+    Iterator[tuple[int, dict]]
+        An iterator over (item number, item) pairs, where the item number counts
+        items (not lines) from 0. Lines which are not a JSON object, or whose
+        sequence is neither a string nor a list of strings, give an item with the
+        key `error`. Empty TSV cells are left out of the item.
+    """
+    is_jsonl = filename.endswith((".jsonl", ".json"))
+    with open(filename, "r") as f:
+        header = None if is_jsonl else f.readline().rstrip("\r\n").split("\t")
+        item_number = 0
+        for line in f:
+            line = line.rstrip("\r\n")
+            if not line.strip():
+                continue
+
+            if is_jsonl:
+                try:
+                    item = json.loads(line)
+                except json.JSONDecodeError as e:
+                    item = {"error": f"Invalid JSON: {e}"}
+                if not isinstance(item, dict):
+                    item = {"error": f"Expected a JSON object, got {type(item).__name__}."}
+            else:
+                # empty cells fall back to the defaults like missing columns
+                item = {name: value for (name, value) in zip(header, line.split("\t")) if value.strip()}
+
+            # malformed items are passed on (with an empty sequence) so that they get an error record
+            sequence = item.get("sequence", [])
+            if isinstance(sequence, str):
+                sequence = sequence.split()
+            elif not (isinstance(sequence, list) and all(isinstance(word, str) for word in sequence)):
+                item.setdefault("error", "The sequence is neither a string nor a list of strings.")
+                sequence = []
+            item["sequence"] = sequence
+
+            yield (item_number, item)
+            item_number += 1
+
+
+def _completed_items(filename: str) -> set[int]:
+    """
+    Collect the item numbers already written to the output file `filename`.
+
+    A line cut off by an interrupted run is removed from the file so that
+    new results can be appended to it.
+    """
+    if not os.path.exists(filename):
+        return set()
+
+    with open(filename, "rb+") as f:
+        content = f.read()
+        last_newline = content.rfind(b"\n")
+        if last_newline != len(content) - 1:
+            f.truncate(last_newline + 1)
+            content = content[:last_newline + 1]
+
+    lines = content.decode().splitlines()
+    if filename.endswith((".jsonl", ".json")):
+        return {json.loads(line)["item"] for line in lines if line.strip()}
+
+    # TSV output, the first line is the header and the first column the item number
+    return {int(line.split("\t")[0]) for line in lines[1:] if line.strip()}
+
+
+def _init_worker(language: Language, model_name: str):
+    global _model, _model_name
+    parameters = [np.float64(0.0)] * len(MODEL_PARAMETERS[model_name])
+    _model = MODELS[model_name](language, *parameters)
+    _model_name = model_name
+
+
+def _score_item(item: dict) -> tuple[float, str | None]:
+    # an item that cannot be scored is recorded with its error rather than ending the run,
+    # so that resuming moves past it
+    try:
+        return (float(_model.difficulty(item["sequence"], get_parameters(_model_name, item))), None)
+    except Exception as e:
+        return (float("nan"), f"{type(e).__name__}: {e}")
+
+
+def _format_result(item_number: int, item: dict, difficulty: float, error: str | None, fields: list[str], jsonl: bool) -> str:
+    if jsonl:
+        result = {"item": item_number}
+        result.update({field: item[field] for field in fields if field in item})
+        result["sequence"] = " ".join(item["sequence"])
+        result["difficulty"] = difficulty if np.isfinite(difficulty) else None
+        if error is not None:
+            result["error"] = error
+        return json.dumps(result, allow_nan = False)
+
+    values = [str(item_number), " ".join(item["sequence"])]
+    values += [str(item.get(field, "")) for field in fields]
+    values.append(str(difficulty))
+    values.append("" if error is None else " ".join(error.split()))
+    return "\t".join(values)
+
+
+def score_file(
+    language: Language,
+    model_name: str,
+    input_filename: str,
+    output_filename: str,
+    defaults: dict | None = None,
+    workers: int = 0,
+    resume: bool = True,
+    log: TextIO | None = None
+) -> int:
+    """
+    Score all items in `input_filename` and write the results to `output_filename`.
+
+    Items are read lazily and results are written (and flushed) in input order as soon
+    as they are ready, so that only a bounded number of items is kept in memory at any time.
+    If `resume` is set, items already present in the output file are skipped and new results
+    are appended. Items which cannot be scored (e.g. with an empty sequence or a missing parameter)
+    are written with a difficulty of `NaN` (`null` in JSONL) and an error message.
+
+    Args
+    ----
+    language : language.Language
+        The language the model is initialised with.
+    model_name : str
+        One of `"progressive"`, `"deletion"` and `"surprisal"`.
+    input_filename : str
+        A TSV or JSONL file with one item per line, see `read_items`.
+    output_filename : str
+        The file to write results to, as JSONL if it ends in `.jsonl` and otherwise as TSV.
+    defaults : dict | None (default `None`)
+        Parameter values used for items which do not specify them.
+    workers : int (default `0`)
+        The number of worker processes. With `0` all items are scored in the current process.
+    resume : bool (default `True`)
+        Skip items already in `output_filename` instead of overwriting it.
+    log : TextIO | None (default `None`)
+        Where to report progress, if anywhere.
+
+    Returns
+    -------
+    int
+        The number of items scored in this run.
+    """
+    defaults = defaults or {}
+    fields = ["id"] + MODEL_PARAMETERS[model_name]
+    jsonl = output_filename.endswith((".jsonl", ".json"))
+
+    completed = _completed_items(output_filename) if resume else set()
+    write_header = not jsonl and not completed
+    output = open(output_filename, "a" if completed else "w")
+    if write_header:
+        output.write("\t".join(["item", "sequence"] + fields + ["difficulty", "error"]) + "\n")
+
+    def pending_items() -> Iterator[tuple[int, dict, str | None]]:
+        # yields the items together with the reason they cannot be scored, if any
+        for (item_number, item) in read_items(input_filename):
+            if item_number in completed:
+                continue
+
+            if "error" in item:
+                yield (item_number, item, item["error"])
+                continue
+
+            if not item["sequence"]:
+                yield (item_number, item, "The sequence is empty.")
+                continue
+
+            missing = [parameter for parameter in MODEL_PARAMETERS[model_name] if parameter not in item and parameter not in defaults]
+            if missing:
+                yield (item_number, item, f"No value for '{missing[0]}' and no default is given.")
+                continue
+
+            for parameter in MODEL_PARAMETERS[model_name]:
+                item.setdefault(parameter, defaults.get(parameter))
+
+            yield (item_number, item, None)
+
+    def write(item_number: int, item: dict, result: tuple[float, str | None]):
+        output.write(_format_result(item_number, item, *result, fields, jsonl) + "\n")
+        output.flush()
+        if log is not None and (n_scored + 1) % 100 == 0:
+            print(f"Scored {n_scored + 1} items", file = log)
+
+    n_scored = 0
+    try:
+        if workers == 0:
+            _init_worker(language, model_name)
+            for (item_number, item, error) in pending_items():
+                write(item_number, item, _score_item(item) if error is None else (float("nan"), error))
+                n_scored += 1
+        else:
+            # keep a bounded window of items in flight and write them in order
+            with ProcessPoolExecutor(workers, initializer = _init_worker, initargs = (language, model_name)) as executor:
+                in_flight = deque()
+                for (item_number, item, error) in pending_items():
+                    if error is None:
+                        future = executor.submit(_score_item, item)
+                    else:
+                        future = Future()
+                        future.set_result((float("nan"), error))
+                    in_flight.append((item_number, item, future))
+                    if len(in_flight) >= 4*workers:
+                        (done_number, done_item, future) = in_flight.popleft()
+                        write(done_number, done_item, future.result())
+                        n_scored += 1
+
+                while in_flight:
+                    (done_number, done_item, future) = in_flight.popleft()
+                    write(done_number, done_item, future.result())
+                    n_scored += 1
+    finally:
+        output.close()
+
+    return n_scored
+
+
+def load_language(args: argparse.Namespace) -> Language:
+    if args.language is not None:
+        return Language.from_file(args.language)
+
+    if args.grammar_name is not None:
+        return grammars.get_language(args.grammar_name, args.max_depth, args.cache_dir, args.mass)
+
+    from nltk.grammar import PCFG
+
+    with open(args.grammar, "r") as f:
+        grammar = PCFG.fromstring(f.read())
+
+    return Language.from_grammar(grammar, args.max_depth, args.mass)
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(
+        prog = "lossy",
+        description = "Calculate lossy-context surprisal for every item in a TSV or JSONL file."
+    )
+    source = parser.add_mutually_exclusive_group(required = True)
+    source.add_argument("--grammar", help = "file containing a PCFG in the format read by nltk.grammar.PCFG.fromstring")
+    source.add_argument("--language", help = "language file written by language.save_language")
+    source.add_argument("--grammar-name", choices = list(grammars.GRAMMARS), help = "one of the grammars in grammars.GRAMMARS")
+    parser.add_argument("--cache-dir", default = None, help = "directory to read (or write) the language of --grammar-name from (or to)")
+    parser.add_argument("--max-depth", type = int, default = None, help = "maximal derivation depth when generating the language from --grammar")
+    parser.add_argument("--mass", type = float, default = None, help = "only generate the most probable sentences covering this fraction of the probability mass")
+    parser.add_argument("--model", choices = list(MODELS), default = "progressive")
+    parser.add_argument("--delta", type = float, help = "default max retention probability for the progressive noise model")
+    parser.add_argument("--nu", type = float, help = "default rate falloff for the progressive noise model")
+    parser.add_argument("--deletion-rate", type = float, help = "default deletion rate for the simple deletion model")
+    parser.add_argument("--workers", type = int, default = 0, help = "number of worker processes (0 scores in this process)")
+    parser.add_argument("--no-resume", action = "store_true", help = "overwrite the output file instead of resuming")
+    parser.add_argument("input", help = "items to score, one per line (.tsv or .jsonl)")
+    parser.add_argument("output", help = "file to append results to (.tsv or .jsonl)")
+    args = parser.parse_args(argv)
+
+    defaults = {
+        parameter: getattr(args, parameter)
+        for parameter in ["delta", "nu", "deletion_rate"]
+        if getattr(args, parameter) is not None
+    }
+
+    try:
+        language = load_language(args)
+    except ValueError as e:
+        parser.error(str(e))
+
+    n_scored = score_file(
+        language,
+        args.model,
+        args.input,
+        args.output,
+        defaults = defaults,
+        workers = args.workers,
+        resume = not args.no_resume,
+        log = sys.stderr
+    )
+    print(f"Scored {n_scored} items", file = sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+from typing import NamedTuple
+
+import numpy as np
+
+from lossy import ProgressiveNoiseModel, ProgressiveNoiseParams
+
+# the default starting points of the optimiser, as (delta, nu)
+STARTS = [(0.5, 0.5), (0.2, 0.2), (0.2, 0.8), (0.8, 0.2), (0.8, 0.8)]
+
+
+class Fit(NamedTuple):
+    """The estimates of a `ReadingTimeModel` fit."""
+    delta: float
+    nu: float
+    intercept: float
+    slope: float
+    sigma: float
+    objective: float # negative log posterior density (or likelihood without priors), up to a constant
+
+
+class ReadingTimeModel:
+    """
+    Reading times regressed on the processing difficulty predicted by a `lossy.ProgressiveNoiseModel`,
+    the model of `fit_models.ipynb` fitted by optimisation instead of sampling:
+
+    `rt[i, j] = intercept + slope * D(sequences[j]; delta, nu) + noise`, `noise ~ Normal(0, sigma)`.
+
+    For given `delta`, `nu` and `sigma` the best intercept and slope follow from (penalised) least
+    squares, so only `delta`, `nu` and `log(sigma)` are optimised, with L-BFGS-B and the analytic
+    gradient of `ProgressiveNoiseModel.cache_calculate_processing_difficulty_gradient`. Without priors
+    the fit is the maximum likelihood estimate, with priors the MAP estimate (parameters without a
+    prior having a flat one). Like the notebook's `alpha ~ N(225, 30)` and `F ~ N(4, 1)`, priors on
+    the intercept and slope keep the fit from trading a huge intercept against a huge slope when
+    there are only a few means to fit.
+
+    Args
+    ----
+    model : lossy.ProgressiveNoiseModel
+        The model predicting processing difficulty; its own parameters are not used.
+    sequences : list[list[str]]
+        The sequences whose last word the reading times were measured on.
+    delta_prior : tuple[float, float] | None (default `None`)
+        The parameters (a, b) of a Beta prior on `delta`.
+    nu_prior : tuple[float, float] | None (default `None`)
+        The parameters (a, b) of a Beta prior on `nu`.
+    intercept_prior : tuple[float, float] | None (default `None`)
+        The mean and standard deviation of a Normal prior on the intercept.
+    slope_prior : tuple[float, float] | None (default `None`)
+        The mean and standard deviation of a Normal prior on the slope.
+    """
+    def __init__(
+        self,
+        model: ProgressiveNoiseModel,
+        sequences: list[list[str]],
+        delta_prior: tuple[float, float] | None = None,
+        nu_prior: tuple[float, float] | None = None,
+        intercept_prior: tuple[float, float] | None = None,
+        slope_prior: tuple[float, float] | None = None
+    ):
+        self.sequences = sequences
+        self.priors = [delta_prior, nu_prior]
+        self.regression_priors = [intercept_prior, slope_prior]
+        self._difficulty_functions = [model.cache_calculate_processing_difficulty_gradient(sequence) for sequence in sequences]
+
+
+    def difficulties(self, params: tuple) -> tuple[np.ndarray, np.ndarray]:
+        """Return the processing difficulty of every sequence and its gradient, as arrays of shape (n,) and (n, 2)."""
+        results = [function(params) for function in self._difficulty_functions]
+        return (np.array([difficulty for (difficulty, _) in results]), np.array([gradient for (_, gradient) in results]))
+
+
+    def regress(self, difficulties: np.ndarray, reading_times: np.ndarray, sigma: float) -> tuple[float, float]:
+        """
+        Return the intercept and slope maximising the posterior density of `reading_times` given the
+        `difficulties` of the sequences and `sigma`; without priors on them, the least-squares fit.
+        """
+        reading_times = np.atleast_2d(reading_times)
+
+        # every row shares the same difficulties, so the fit only depends on the means per sequence
+        scale = np.sqrt(len(reading_times)) / sigma
+        rows = [scale * np.column_stack([np.ones(len(difficulties)), difficulties])]
+        targets = [scale * reading_times.mean(axis = 0)]
+
+        # a Normal prior is one more observation of its parameter
+        for (i, prior) in enumerate(self.regression_priors):
+            if prior is not None:
+                (mean, sd) = prior
+                rows.append(np.eye(2)[[i]] / sd)
+                targets.append([mean / sd])
+
+        ((intercept, slope), *_) = np.linalg.lstsq(np.vstack(rows), np.concatenate(targets), rcond = None)
+        return (intercept, slope)
+
+
+    def objective(self, x: np.ndarray, reading_times: np.ndarray) -> tuple[float, np.ndarray]:
+        """
+        Return the objective minimised by `fit` at `x = (delta, nu, log(sigma))` and its gradient.
+
+        The objective is the negative log posterior density (the negative log likelihood without
+        priors) up to a constant, with the intercept and slope at their best values given `x`.
+        """
+        reading_times = np.atleast_2d(reading_times)
+        (delta, nu, log_sigma) = x
+        sigma = np.exp(log_sigma)
+
+        (difficulties, difficulty_gradients) = self.difficulties(ProgressiveNoiseParams(delta, nu))
+        (intercept, slope) = self.regress(difficulties, reading_times, sigma)
+        residual_sum = np.sum((reading_times - intercept - slope*difficulties)**2)
+
+        value = reading_times.size*log_sigma + residual_sum / (2*sigma**2)
+        gradient = np.zeros(3)
+
+        # the intercept and slope are optimal, so only the direct dependence on D and sigma counts
+        mean_residuals = reading_times.mean(axis = 0) - intercept - slope*difficulties
+        gradient[:2] = -len(reading_times) * slope * (mean_residuals @ difficulty_gradients) / sigma**2
+        gradient[2] = reading_times.size - residual_sum / sigma**2
+
+        for (prior, estimate) in zip(self.regression_priors, (intercept, slope)):
+            if prior is not None:
+                (mean, sd) = prior
+                value += (estimate - mean)**2 / (2*sd**2)
+
+        for (i, prior) in enumerate(self.priors):
+            if prior is not None:
+                (a, b) = prior
+                value -= (a - 1)*np.log(x[i]) + (b - 1)*np.log(1 - x[i])
+                gradient[i] -= (a - 1)/x[i] - (b - 1)/(1 - x[i])
+
+        return (value, gradient)
+
+
+    def fit(
+        self,
+        reading_times: np.ndarray,
+        starts: list[tuple[float, float]] | None = None,
+        eps: float = 1e-6
+    ) -> Fit:
+        """
+        Fit the model to `reading_times`.
+
+        Args
+        ----
+        reading_times : np.ndarray
+            The reading times, of shape (n, len(sequences)) with one row per participant or draw
+            (e.g. the data drawn in `fit_models.ipynb`), or of shape (len(sequences),) for a single
+            row of means (e.g. a column of one of the data frames in `expdata.py`).
+        starts : list[tuple[float, float]] | None (default `None`)
+            The (delta, nu) to start the optimiser from, keeping the best result. Defaults to `STARTS`.
+        eps : float (default `1e-6`)
+            `delta` and `nu` are kept within [eps, 1-eps].
+
+        Returns
+        -------
+        Fit
+            The estimates.
+        """
+        from scipy.optimize import minimize
+
+        reading_times = np.atleast_2d(np.asarray(reading_times, dtype = np.float64))
+        if reading_times.shape[1] != len(self.sequences):
+            raise ValueError(f"Expected reading times for {len(self.sequences)} sequences, got {reading_times.shape[1]}.")
+
+        best = None
+        for start in (STARTS if starts is None else starts):
+            start = np.clip(start, eps, 1 - eps)
+
+            # start sigma at the spread of the residuals of the least-squares fit
+            (difficulties, _) = self.difficulties(ProgressiveNoiseParams(*start))
+            design = np.column_stack([np.ones(len(difficulties)), difficulties])
+            ((intercept, slope), *_) = np.linalg.lstsq(design, reading_times.mean(axis = 0), rcond = None)
+            sigma = np.sqrt(np.mean((reading_times - intercept - slope*difficulties)**2))
+
+            result = minimize(
+                self.objective,
+                np.append(start, np.log(max(sigma, 1e-3*np.std(reading_times), 1e-8))),
+                args = (reading_times,),
+                jac = True,
+                method = "L-BFGS-B",
+                bounds = [(eps, 1 - eps)] * 2 + [(None, None)]
+            )
+            if best is None or result.fun < best.fun:
+                best = result
+
+        (delta, nu, log_sigma) = best.x
+        (difficulties, _) = self.difficulties(ProgressiveNoiseParams(delta, nu))
+        (intercept, slope) = self.regress(difficulties, reading_times, np.exp(log_sigma))
+        return Fit(float(delta), float(nu), float(intercept), float(slope), float(np.exp(log_sigma)), float(best.fun))
+
+
+    def bootstrap(
+        self,
+        reading_times: np.ndarray,
+        n_resamples: int = 1000,
+        resample: str = "rows",
+        seed: int | None = None
+    ) -> dict[str, np.ndarray]:
+        """
+        Refit the model to resampled reading times, e.g. for confidence intervals with `np.quantile`.
+
+        Each refit starts from the fit to the full data.
+
+        Args
+        ----
+        reading_times : np.ndarray
+            The reading times, see `fit`.
+        n_resamples : int (default `1000`)
+            The number of resamples.
+        resample : str (default `"rows"`)
+            `"rows"` draws rows of `reading_times` with replacement, which needs more than one row;
+            `"residuals"` adds residuals of the full fit, drawn with replacement, to its fitted values,
+            which also works for a single row of means.
+        seed : int | None (default `None`)
+            The seed of the random number generator.
+
+        Returns
+        -------
+        dict[str, np.ndarray]
+            The estimates of every resample, keyed by the fields of `Fit`.
+        """
+        reading_times = np.atleast_2d(np.asarray(reading_times, dtype = np.float64))
+        if resample not in ("rows", "residuals"):
+            raise ValueError(f"Unknown resampling method '{resample}'.")
+        if resample == "rows" and len(reading_times) < 2:
+            raise ValueError("Resampling rows needs more than one row of reading times; use `resample = \"residuals\"`.")
+
+        rng = np.random.default_rng(seed)
+        full_fit = self.fit(reading_times)
+        (difficulties, _) = self.difficulties(ProgressiveNoiseParams(full_fit.delta, full_fit.nu))
+        fitted = full_fit.intercept + full_fit.slope*difficulties
+        residuals = (reading_times - fitted).ravel()
+
+        fits = []
+        for _ in range(n_resamples):
+            if resample == "rows":
+                sample = reading_times[rng.integers(len(reading_times), size = len(reading_times))]
+            else:
+                sample = fitted + rng.choice(residuals, size = reading_times.shape)
+            fits.append(self.fit(sample, starts = [(full_fit.delta, full_fit.nu)]))
+
+        return {field: np.array([getattr(fit, field) for fit in fits]) for field in Fit._fields}
+
+
+if __name__ == "__main__":
+    # recover the parameters of the synthetic data of `fit_models.ipynb`
+    import time
+    import grammars
+
+    model = ProgressiveNoiseModel(grammars.get_language("russian"), 0.7, 0.5)
+    sequences = [sequence.split() for sequence in ["RPNom V", "RPNom DO V", "RPAcc V", "RPAcc Subj V"]]
+    reading_time_model = ReadingTimeModel(model, sequences)
+
+    (difficulties, _) = reading_time_model.difficulties(ProgressiveNoiseParams(0.7, 0.5))
+    rng = np.random.default_rng(12)
+    data = 200 + 10*difficulties + rng.normal(0, 0.1, size = (100, len(sequences)))
+
+    tic = time.perf_counter()
+    print(reading_time_model.fit(data))
+    print(f"Fitted in {time.perf_counter() - tic} seconds.")
+
+    tic = time.perf_counter()
+    samples = reading_time_model.bootstrap(data, n_resamples = 200, seed = 12)
+    print({field: np.quantile(values, [0.025, 0.975]) for (field, values) in samples.items() if field != "objective"})
+    print(f"Bootstrapped in {time.perf_counter() - tic} seconds.")
@@ -1,5 +1,12 @@
+import functools
+import os
+from typing import TYPE_CHECKING, Callable
+
 import numpy as np
-from nltk.grammar import PCFG
+
+if TYPE_CHECKING:
+    from nltk.grammar import PCFG
+    from language import Language
 
 def gen_russian_grammar_exp2(
     p_src: np.float64, 
@@ -49,19 +56,17 @@ def gen_hindi_grammar_exp2(
     SPVerb -> 'LightVerb' [{p_sp_lightverb}] | 'OtherVerb' [{1-p_sp_lightverb}]
     """
 
-# the grammars used in the article
-pcfg_russian = PCFG.fromstring(
-    gen_russian_grammar_exp2(
-        p_src = 0.57,#0.58, 
-        p_src_local = 0.94,#0.99,
-        p_src_case_marked = 0.9,
-        p_orc_local = 0.37,#0.36,
-        p_orc_case_marked = 0.83,
-        p_one_arg = 0.93,#0.97, 
-        p_adj_interveners = 0.16, 
-        p_one_adj = 0.95
-    )
-)
+# the parameters of the grammars used in the article
+russian_params = {
+    "p_src": 0.57,#0.58,
+    "p_src_local": 0.94,#0.99,
+    "p_src_case_marked": 0.9,
+    "p_orc_local": 0.37,#0.36,
+    "p_orc_case_marked": 0.83,
+    "p_one_arg": 0.93,#0.97,
+    "p_adj_interveners": 0.16,
+    "p_one_adj": 0.95
+}
 
 hindi_p_cp = 0.5
 hindi_p_cp_intv = 0.05
@@ -79,8 +84,10 @@ persian_p_sp_intv = 0.02
 persian_p_sp_short = 0.99
 persian_p_sp_lightverb = 0.33
 
-pcfg_cpsp_hindi = PCFG.fromstring(
-    gen_hindi_grammar_exp2(
+# grammar strings of the named grammars, only formatted when they are needed
+GRAMMARS: dict[str, Callable[[], str]] = {
+    "russian": lambda: gen_russian_grammar_exp2(**russian_params),
+    "hindi": lambda: gen_hindi_grammar_exp2(
         p_cp = hindi_p_cp,
         p_cp_intv = hindi_p_cp_intv,
         p_cp_short = hindi_p_cp_short,
@@ -88,11 +95,8 @@ pcfg_cpsp_hindi = PCFG.fromstring(
         p_sp_intv = hindi_p_sp_intv,
         p_sp_short = hindi_p_sp_short,
         p_sp_lightverb = hindi_p_sp_lightverb
-    )
-)
-
-pcfg_cpsp_persian = PCFG.fromstring(
-    gen_hindi_grammar_exp2(
+    ),
+    "persian": lambda: gen_hindi_grammar_exp2(
         p_cp = persian_p_cp,
         p_cp_intv = persian_p_cp_intv,
         p_cp_short = persian_p_cp_short,
@@ -100,5 +104,89 @@ pcfg_cpsp_persian = PCFG.fromstring(
         p_sp_intv = persian_p_sp_intv,
         p_sp_short = persian_p_sp_short,
         p_sp_lightverb = persian_p_sp_lightverb
-    )
-)
\ No newline at end of file
+    ),
+}
+
+# the names under which the grammars used to be built on import
+_LEGACY_NAMES = {
+    "pcfg_russian": "russian",
+    "pcfg_cpsp_hindi": "hindi",
+    "pcfg_cpsp_persian": "persian",
+}
+
+
+def register_grammar(name: str, grammar: str | Callable[[], str]):
+    """Add a grammar string (or a function returning one) to the registry under `name`."""
+    GRAMMARS[name] = grammar if callable(grammar) else (lambda: grammar)
+    get_grammar.cache_clear()
+    get_language.cache_clear()
+
+
+@functools.cache
+def get_grammar(name: str) -> "PCFG":
+    """Build the PCFG registered under `name`, caching it for later calls."""
+    from nltk.grammar import PCFG
+
+    return PCFG.fromstring(GRAMMARS[name]())
+
+
+@functools.cache
+def get_language(
+    name: str,
+    max_depth: int | None = None,
+    cache_dir: str | None = None,
+    mass: float | None = None
+) -> "Language":
+    """
+    Get the language of the grammar registered under `name`, caching it for later calls.
+
+    The same `language.Language` is returned on every call with the same arguments,
+    so that all models built from it share it.
+
+    If `cache_dir` is given, the language is read from the directory `<cache_dir>/<name>`
+    (with `_depth<max_depth>` or `_mass<mass>` appended if given) if it exists, which needs
+    neither the grammar nor `nltk`. Otherwise it is generated and, if `cache_dir` is given,
+    written there with `Language.save_arrays`, which also keeps its `uncovered_mass`.
+
+    Args
+    ----
+    name : str
+        The name of the grammar in `GRAMMARS`.
+    max_depth : int | None (default `None`)
+        `max_depth` argument to `language.generate_language`.
+    cache_dir : str | None (default `None`)
+        A directory to read the language from or write it to.
+    mass : float | None (default `None`)
+        `mass` argument to `language.generate_language`.
+
+    Returns
+    -------
+    language.Language
+        The language.
+    """
+    from language import Language
+
+    path = None
+    if cache_dir is not None:
+        # `max_depth` is ignored when `mass` is given
+        if mass is not None:
+            suffix = f"_mass{mass}"
+        else:
+            suffix = "" if max_depth is None else f"_depth{max_depth}"
+        path = os.path.join(cache_dir, f"{name}{suffix}")
+        # `uncovered_mass.npy` is written last, so its presence means the language is complete
+        if os.path.exists(os.path.join(path, "uncovered_mass.npy")):
+            return Language.open_arrays(path)
+
+    language = Language.from_grammar(get_grammar(name), max_depth, mass)
+    if path is not None:
+        language.save_arrays(path)
+
+    return language
+
+
+def __getattr__(name: str):
+    if name in _LEGACY_NAMES:
+        return get_grammar(_LEGACY_NAMES[name])
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
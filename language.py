@@ -1,25 +1,38 @@
-from nltk.parse.pchart import LongestChartParser
-from nltk.parse.generate import generate
-from nltk.grammar import PCFG
+from typing import TYPE_CHECKING, Iterator
+import heapq
+import itertools
+import os
+import sys
+import threading
 import numpy as np
 import re
 
+if TYPE_CHECKING:
+    from nltk.grammar import PCFG
+
 def generate_language(
-    grammar: PCFG,
-    max_depth: int | None = None
+    grammar: "PCFG",
+    max_depth: int | None = None,
+    mass: float | None = None
 ) -> list[tuple[list[str], np.float64]]:
     """
     Generate all sequences and subsequences from an NLTK PCFG.
 
-    Subsequence probabilities are found by summing over all whole
-    sequences beginning with the specific subsequence.
+    The probability of a whole sequence is the sum of the probabilities of its
+    derivations, which are found while generating it. Subsequence probabilities
+    are found by summing over all whole sequences beginning with the specific
+    subsequence.
 
     Args
     ----
     grammar : nltk.grammar.PCFG
         The probabilistic context-free grammar to generate sequences from.
     max_depth : int | None (default `None`)
-        `depth` argument to `nltk.parse.generate.generate`.
+        `depth` argument to `generate_with_probs`, the maximal depth of a derivation.
+    mass : float | None (default `None`)
+        If given, only the most probable sequences covering this fraction of the
+        probability mass are generated, see `generate_language_best_first`.
+        `max_depth` is then ignored.
 
     Returns
     -------
@@ -28,33 +41,187 @@ def generate_language(
         a list of strings and its associated probability in the
         PCFG.
     """
-    parser = LongestChartParser(grammar)
+    if mass is not None:
+        (language, _) = generate_language_best_first(grammar, mass)
+        return language
 
-    # generate all possible sequences from the grammar
-    language: list[tuple[list[str], np.float64]] = []
-    for sequence in generate(grammar, depth = max_depth):
-        sequence_prob = next(parser.parse(sequence)).prob()
-        language.append((sequence, np.float64(sequence_prob)))
-
-    # add subsequences to the language
-    sub_sequences = []
-    sub_sequence_probs = []
-    for (language_sequence, _) in language:
-        for i in range(1, len(language_sequence)):
-            sub_sequence = language_sequence[:i]
-            if sub_sequence in sub_sequences:
+    # generate all possible sequences from the grammar, summing over their derivations
+    sequence_probs: dict[tuple[str, ...], float] = {}
+    try:
+        for (sequence, prob) in generate_with_probs(grammar, max_depth):
+            sequence = tuple(sequence)
+            sequence_probs[sequence] = sequence_probs.get(sequence, 0.0) + prob
+    except RecursionError:
+        raise RuntimeError("The grammar has rule(s) that yield infinite recursion, set `max_depth` or `mass`.")
+
+    language = [(list(sequence), np.float64(prob)) for (sequence, prob) in sequence_probs.items()]
+    return add_subsequences(language)
+
+
+def generate_with_probs(
+    grammar: "PCFG",
+    depth: int | None = None
+) -> Iterator[tuple[list[str], float]]:
+    """
+    Generate all derivations of an NLTK PCFG together with their probabilities.
+
+    Works like `nltk.parse.generate.generate`, yielding the sequences in the same order,
+    but also multiplies the probabilities of the rules used along each derivation, so that
+    no sequence has to be parsed again afterwards. A sequence with several derivations is
+    yielded once for each of them.
+
+    Args
+    ----
+    grammar : nltk.grammar.PCFG
+        The probabilistic context-free grammar to generate sequences from.
+    depth : int | None (default `None`)
+        The maximal depth of the derivation trees, as in `nltk.parse.generate.generate`.
+
+    Returns
+    -------
+    Iterator[tuple[list[str], float]]
+        An iterator over (sequence, derivation probability) pairs.
+    """
+    from nltk.grammar import Nonterminal
+
+    if depth is None:
+        depth = (sys.getrecursionlimit() // 3) - 3
+
+    def generate_all(items: tuple, depth: int) -> Iterator[tuple[list[str], float]]:
+        if not items:
+            yield ([], 1.0)
+            return
+
+        for (first, first_prob) in generate_one(items[0], depth):
+            for (rest, rest_prob) in generate_all(items[1:], depth):
+                yield (first + rest, first_prob * rest_prob)
+
+    def generate_one(item, depth: int) -> Iterator[tuple[list[str], float]]:
+        if depth <= 0:
+            return
+
+        if isinstance(item, Nonterminal):
+            for production in grammar.productions(lhs = item):
+                for (sequence, prob) in generate_all(production.rhs(), depth - 1):
+                    yield (sequence, production.prob() * prob)
+        else:
+            yield ([item], 1.0)
+
+    yield from generate_all((grammar.start(),), depth)
+
+
+def generate_language_best_first(
+    grammar: "PCFG",
+    mass: float = 1.0
+) -> tuple[list[tuple[list[str], np.float64]], np.float64]:
+    """
+    Generate the most probable sequences of an NLTK PCFG, and their subsequences,
+    until they cover a given fraction of the probability mass.
+
+    Derivations are expanded leftmost-first from a priority queue ordered by their
+    probability, so whole sequences are found in order of decreasing probability
+    and recursive grammars with infinite languages can be used as long as `mass` is
+    below 1. The probabilities of different derivations of the same sequence are summed.
+
+    Args
+    ----
+    grammar : nltk.grammar.PCFG
+        The probabilistic context-free grammar to generate sequences from.
+    mass : float (default `1.0`)
+        Generation stops as soon as the generated whole sequences have at least this
+        total probability. With `1.0` the whole language is generated, which is only
+        possible for grammars without recursion.
+
+    Returns
+    -------
+    tuple
+        The language, in the format returned by `generate_language`, and the
+        probability mass of all whole sequences that were not generated.
+    """
+    from nltk.grammar import Nonterminal
+
+    # the mass of a recursive grammar is only ever approached, so generation would never stop
+    if mass >= 1.0 and is_recursive(grammar):
+        raise ValueError("The grammar is recursive, so its whole language cannot be generated; set `mass` below 1.")
+
+    def split_terminals(prefix: tuple, rest: tuple) -> tuple[tuple, tuple]:
+        # move the terminals at the start of `rest` to the end of `prefix`
+        i = 0
+        while i < len(rest) and not isinstance(rest[i], Nonterminal):
+            i += 1
+        return (prefix + rest[:i], rest[i:])
+
+    counter = itertools.count()
+    queue = [(-1.0, next(counter), *split_terminals((), (grammar.start(),)))]
+
+    sequence_probs: dict[tuple[str, ...], float] = {}
+    covered_mass = 0.0
+    while queue and covered_mass < mass:
+        (neg_prob, _, prefix, rest) = heapq.heappop(queue)
+        if not rest:
+            sequence_probs[prefix] = sequence_probs.get(prefix, 0.0) - neg_prob
+            covered_mass -= neg_prob
+            continue
+
+        for production in grammar.productions(lhs = rest[0]):
+            if production.prob() == 0:
                 continue
+            heapq.heappush(queue, (
+                neg_prob * production.prob(),
+                next(counter),
+                *split_terminals(prefix, production.rhs() + rest[1:])
+            ))
 
-            sub_sequence_prob = np.float64(0.0)
-            for (sequence, prob) in language:
-                if sequence[:i] == sub_sequence:
-                    sub_sequence_prob += prob
+    language = [(list(sequence), np.float64(prob)) for (sequence, prob) in sequence_probs.items()]
+    return (add_subsequences(language), np.float64(max(1.0 - covered_mass, 0.0)))
 
-            sub_sequences.append(sub_sequence)
-            sub_sequence_probs.append(sub_sequence_prob)
 
-    language += list(zip(sub_sequences, sub_sequence_probs))
-    return language
+def is_recursive(grammar: "PCFG") -> bool:
+    """Check whether a nonterminal of `grammar` can derive itself with non-zero probability."""
+    from nltk.grammar import Nonterminal
+
+    children: dict = {}
+    for production in grammar.productions():
+        if production.prob() > 0:
+            children.setdefault(production.lhs(), set()).update(
+                item for item in production.rhs() if isinstance(item, Nonterminal)
+            )
+
+    # depth-first search for a cycle, with the nonterminals on the current path marked as visiting
+    (visiting, done) = (1, 2)
+    state: dict = {}
+
+    def has_cycle(nonterminal) -> bool:
+        state[nonterminal] = visiting
+        for child in children.get(nonterminal, ()):
+            if state.get(child) == visiting or (child not in state and has_cycle(child)):
+                return True
+        state[nonterminal] = done
+        return False
+
+    return any(nonterminal not in state and has_cycle(nonterminal) for nonterminal in children)
+
+
+def add_subsequences(language: list[tuple[list[str], np.float64]]) -> list[tuple[list[str], np.float64]]:
+    """
+    Add all proper subsequences starting at the beginning of a sequence to a
+    language of whole sequences, with the summed probability of all whole
+    sequences they begin.
+    """
+    sub_sequence_probs: dict[tuple[str, ...], np.float64] = {}
+    for (sequence, _) in language:
+        for i in range(1, len(sequence)):
+            sub_sequence_probs[tuple(sequence[:i])] = np.float64(0.0)
+
+    # a subsequence may itself be a whole sequence, which then also counts towards its probability
+    for (sequence, prob) in language:
+        for i in range(1, len(sequence) + 1):
+            sub_sequence = tuple(sequence[:i])
+            if sub_sequence in sub_sequence_probs:
+                sub_sequence_probs[sub_sequence] += prob
+
+    return language + [(list(sub_sequence), prob) for (sub_sequence, prob) in sub_sequence_probs.items()]
+
 
 def save_language(
     language: list[tuple[list[str], np.float64]],
@@ -84,7 +251,274 @@ def read_language(filename: str) -> list[tuple[list[str], np.float64]]:
     return language
 
 
+class Language:
+    """
+    A language, i.e. sequences and subsequences with their probabilities, together with
+    the indexes and caches derived from it.
+
+    A `Language` is built once per grammar and can be shared by reference between any
+    number of `LossyContextModel`s. Iterating over it gives the same (sequence, probability)
+    tuples as the list returned by `generate_language`.
+
+    Args
+    ----
+    sequences : list
+        The language in the format returned by `generate_language`.
+    uncovered_mass : np.float64 (default `0.0`)
+        The probability mass of whole sequences of the grammar missing from `sequences`.
+    """
+    def __init__(
+        self,
+        sequences: list[tuple[list[str], np.float64]],
+        uncovered_mass: np.float64 = np.float64(0.0)
+    ):
+        self.sequences = sequences
+        self.uncovered_mass = np.float64(uncovered_mass)
+
+        # the probability of the first occurrence of each sequence
+        self._probs: dict[tuple[str, ...], np.float64] = {}
+        # the indices of all sequences containing each word
+        self._word_index: dict[str, set[int]] = {}
+        for (i, (sequence, prob)) in enumerate(self.sequences):
+            self._probs.setdefault(tuple(sequence), prob)
+            for word in sequence:
+                self._word_index.setdefault(word, set()).add(i)
+
+        # the caches may be filled from several threads at once; a reconstruction computed twice
+        # is harmless, but the suffix trie is only built once
+        self._reconstructions: dict[frozenset[str], list[list[str]]] = {}
+        self._suffix_trie: SuffixTrie | None = None
+        self._suffix_trie_lock = threading.Lock()
+
+        # the directory the language was opened from with `open_arrays`, if any
+        self._array_path: str | None = None
+
+
+    @classmethod
+    def from_grammar(
+        cls,
+        grammar: "PCFG",
+        max_depth: int | None = None,
+        mass: float | None = None
+    ) -> "Language":
+        """Generate the language of `grammar`, see `generate_language` for the arguments."""
+        if mass is not None:
+            return cls(*generate_language_best_first(grammar, mass))
+
+        return cls(generate_language(grammar, max_depth))
+
+
+    @classmethod
+    def from_file(cls, filename: str) -> "Language":
+        """Read a language written by `save_language` or `Language.save`."""
+        return cls(read_language(filename))
+
+
+    def save(self, filename: str):
+        save_language(self.sequences, filename)
+
+
+    def to_arrays(self) -> dict[str, np.ndarray]:
+        """
+        Return the language as flat arrays: the `vocabulary`, the `words` of all sequences
+        concatenated (as indices into the vocabulary), the `offsets` at which each sequence
+        starts in `words` (with the end as the last entry) and the `probs` of the sequences.
+        """
+        vocabulary = self.get_vocabulary()
+        word_ids = {word: i for (i, word) in enumerate(vocabulary)}
+        lengths = [len(sequence) for (sequence, _) in self.sequences]
+
+        return {
+            "vocabulary": np.array(vocabulary, dtype = str),
+            "words": np.array([word_ids[word] for (sequence, _) in self.sequences for word in sequence], dtype = np.int32),
+            "offsets": np.concatenate([[0], np.cumsum(lengths, dtype = np.int64)]),
+            "probs": np.array([prob for (_, prob) in self.sequences], dtype = np.float64),
+        }
+
+
+    @classmethod
+    def from_arrays(
+        cls,
+        vocabulary: np.ndarray,
+        words: np.ndarray,
+        offsets: np.ndarray,
+        probs: np.ndarray,
+        uncovered_mass: np.float64 = np.float64(0.0)
+    ) -> "Language":
+        """Build a language from the arrays returned by `to_arrays`."""
+        vocabulary = [str(word) for word in vocabulary]
+        words = [vocabulary[i] for i in words]
+        return cls(
+            [(words[start:end], prob) for (start, end, prob) in zip(offsets[:-1], offsets[1:], probs)],
+            uncovered_mass
+        )
+
+
+    def save_arrays(self, path: str):
+        """
+        Write the language to the directory `path` as `.npy` files of the arrays of `to_arrays`,
+        to be read with `open_arrays`.
+        """
+        os.makedirs(path, exist_ok = True)
+        for (name, array) in self.to_arrays().items():
+            np.save(os.path.join(path, f"{name}.npy"), array)
+        np.save(os.path.join(path, "uncovered_mass.npy"), self.uncovered_mass)
+
+
+    @classmethod
+    def open_arrays(cls, path: str) -> "Language":
+        """
+        Read a language written by `save_arrays`.
+
+        A language opened this way is pickled as just `path`, so the pickle stays small, but every
+        process unpickling it reads the arrays again and rebuilds its own sequences and indexes;
+        no memory is shared between processes.
+        """
+        arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"))
+            for name in ["vocabulary", "words", "offsets", "probs"]
+        }
+        language = cls.from_arrays(**arrays, uncovered_mass = np.load(os.path.join(path, "uncovered_mass.npy")))
+        language._array_path = path
+        return language
+
+
+    def __iter__(self) -> Iterator[tuple[list[str], np.float64]]:
+        return iter(self.sequences)
+
+
+    def __len__(self) -> int:
+        return len(self.sequences)
+
+
+    def __getitem__(self, index):
+        return self.sequences[index]
+
+
+    def __reduce__(self):
+        # pickled as flat arrays, or as just the directory if opened with `open_arrays`;
+        # the sequences, indexes and caches are rebuilt on unpickling
+        if self._array_path is not None:
+            return (Language.open_arrays, (self._array_path,))
+
+        return (Language.from_arrays, (*self.to_arrays().values(), self.uncovered_mass))
+
+
+    def get_prob(self, sequence: list[str]) -> np.float64:
+        """Return the a priori probability of `sequence` [p_L(sequence)]."""
+        return self._probs.get(tuple(sequence), np.float64(0.0))
+
+
+    def get_vocabulary(self) -> list[str]:
+        """Return all words in the language, in the order they first occur."""
+        return list(self._word_index)
+
+
+    def get_reconstructions(self, distortion: list[str]) -> list[list[str]]:
+        """
+        Return all sequences, in language order, which contain all of the words in `distortion`.
+
+        Results are cached per set of words.
+        """
+        words = frozenset(distortion)
+        if words not in self._reconstructions:
+            indices = set(range(len(self.sequences)))
+            for word in words:
+                indices &= self._word_index.get(word, set())
+
+            # keep whichever result was stored first if another thread got here as well
+            return self._reconstructions.setdefault(words, [self.sequences[i][0] for i in sorted(indices)])
+
+        return self._reconstructions[words]
+
+
+    def get_suffix_trie(self) -> "SuffixTrie":
+        """Return the trie of all reversed sequences of the language, building it on first use."""
+        if self._suffix_trie is None:
+            with self._suffix_trie_lock:
+                if self._suffix_trie is None:
+                    self._suffix_trie = SuffixTrie(self)
+
+        return self._suffix_trie
+
+
+class SuffixTrie:
+    """
+    A trie of the reversed sequences of a `Language`, stored as flat arrays.
+
+    Reading a sequence backwards, the depth of a node (counting from 0) is the number
+    of steps back from the last word of every sequence ending in it, so quantities that
+    factorise over the words of a sequence with weights depending on the distance from
+    its end can be computed for all sequences at once in a single pass from the root.
+
+    Nodes are numbered level by level, so parents always come before their children.
+    Children of the root have the parent `-1`.
+
+    Attributes
+    ----------
+    vocabulary : list[str]
+        The words of the language; `words` holds indices into this list.
+    parents : np.ndarray
+        The parent of every node.
+    words : np.ndarray
+        The word of every node.
+    new_word : np.ndarray
+        Whether the word of a node does not occur between it and the root.
+    levels : list[np.ndarray]
+        The nodes at each depth.
+    sequence_nodes : np.ndarray
+        The node at which each sequence of the language ends.
+    sequence_probs : np.ndarray
+        The probability of each sequence [p_L(sequence)], as given by `Language.get_prob`.
+    """
+    def __init__(self, language: Language):
+        self.vocabulary = language.get_vocabulary()
+        self.word_ids = {word: i for (i, word) in enumerate(self.vocabulary)}
+
+        # build the trie with one dictionary of children per node, -1 being the root
+        children: dict[int, dict[str, int]] = {-1: {}}
+        node_parents = []
+        node_words = []
+        node_depths = []
+        node_new_word = []
+        sequence_nodes = []
+        for (sequence, _) in language:
+            node = -1
+            seen = set()
+            for (depth, word) in enumerate(reversed(sequence)):
+                if word not in children[node]:
+                    children[node][word] = len(node_parents)
+                    children[len(node_parents)] = {}
+                    node_parents.append(node)
+                    node_words.append(self.word_ids[word])
+                    node_depths.append(depth)
+                    node_new_word.append(word not in seen)
+                seen.add(word)
+                node = children[node][word]
+            sequence_nodes.append(node)
+
+        # renumber the nodes level by level
+        node_depths = np.array(node_depths, dtype = np.int64)
+        order = np.argsort(node_depths, kind = "stable")
+        new_index = np.empty(len(order), dtype = np.int64)
+        new_index[order] = np.arange(len(order))
+        renumber = lambda nodes: np.where(np.asarray(nodes) >= 0, new_index[np.asarray(nodes)], -1)
+
+        self.parents = renumber(node_parents)[order]
+        self.words = np.array(node_words, dtype = np.int64)[order]
+        self.new_word = np.array(node_new_word, dtype = bool)[order]
+        depths = node_depths[order]
+        self.levels = [np.flatnonzero(depths == depth) for depth in range(depths.max() + 1)] if len(depths) else []
+        self.sequence_nodes = renumber(sequence_nodes)
+        self.sequence_probs = np.array([language.get_prob(sequence) for (sequence, _) in language])
+
+
+    def __len__(self) -> int:
+        return len(self.parents)
+
+
 if __name__ == "__main__":
+    from nltk.grammar import PCFG
     from grammars import gen_russian_grammar_exp2
     pcfg_russian = PCFG.fromstring(
         gen_russian_grammar_exp2(
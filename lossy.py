@@ -1,8 +1,10 @@
-from nltk.grammar import PCFG
 import numpy as np
 from abc import ABC, abstractmethod
-from language import generate_language
-from typing import Callable
+from language import Language
+from typing import TYPE_CHECKING, Callable, NamedTuple
+
+if TYPE_CHECKING:
+    from nltk.grammar import PCFG
 
 def print_if_true(text, flag):
     if flag:
@@ -21,28 +23,42 @@ class LossyContextModel(ABC):
     the probability of a sequence `true_sequence` being distorted as a certain other sequence `distortion`.
     A distortion is the true context with zero or more words removed.
 
-    The argument `max_depth` is passed to `nltk.parse.generate.generate`.
+    All calculations take the model parameters as an optional argument `params`, falling back to `self.params`
+    if it is not given. With explicit parameters nothing about the model is changed, so a single model can be
+    used from several threads at once, each with its own parameters (see `difficulty`). For this, a model
+    also has to override the property `params`, giving its own parameters, and `distortion_probability`,
+    the probability of a distortion under any parameters `params`, as the models below do.
+
+    Instead of a grammar, an already generated `language.Language` can be given, which is then
+    shared with all other models using it, or a language as returned by `language.generate_language`.
+
+    The argument `max_depth` is passed to `language.generate_language`.
     """
-    def __init__(self, language: PCFG | list, max_depth: int | None = None):
-        if type(language) == PCFG:
-            self.language = generate_language(language, max_depth)
-        else:
+    def __init__(self, language: "PCFG | Language | list", max_depth: int | None = None):
+        if isinstance(language, Language):
             self.language = language
+        elif isinstance(language, list):
+            self.language = Language(language)
+        else:
+            self.language = Language.from_grammar(language, max_depth)
+
+
+    @property
+    def params(self) -> tuple:
+        """The parameters of the model, used by all calculations not given any explicitly."""
+        return ()
+
 
     def get_prob(self, sequence: list[str]) -> np.float64:
         """Calculate the a priori probability of `sequence` [p_L(sequence)]."""
-        for (language_sequence, probability) in self.language:
-            if language_sequence == sequence:
-                return probability
-            
-        return np.float64(0.0)
+        return self.language.get_prob(sequence)
     
     def get_conditional_prob(self, sequence: list[str]) -> np.float64:
         """Calculate the conditional probability of `sequence[-1]` given `sequence[:-1]`."""
         return self.get_prob(sequence)/self.get_prob(sequence[:-1]) if self.get_prob(sequence[:-1]) != 0 else np.float64(0.0)
 
 
-    def get_distortions(self, sequence: list[str]) -> list[tuple[list[str], np.float64]]:
+    def get_distortions(self, sequence: list[str], params: tuple | None = None) -> list[tuple[list[str], np.float64]]:
         """
         Generate all possible memory representations/distortions from a given sequence.
 
@@ -50,16 +66,20 @@ class LossyContextModel(ABC):
         ----
         sequence : list[str]
             A sequence of words from the grammar.
+        params : tuple | None (default `None`)
+            The model parameters, defaulting to `self.params`.
 
         Returns
         -------
         list[tuple[list[str], np.float64]]
             A list of tuples with the form (distortion, distortion_probability)
         """
+        params = self.params if params is None else params
+
         distortions = []
         # length is the length of the distorted sequence
         for length in range(len(sequence), -1, -1):
-            distortions += [(distortion, self.get_distortion_probability(sequence, distortion))
+            distortions += [(distortion, self.distortion_probability(sequence, distortion, params))
                             for distortion in self._get_distortions_of_length(sequence, length)]
 
         return distortions
@@ -69,6 +89,20 @@ class LossyContextModel(ABC):
     def get_distortion_probability(self, true_sequence: list[str], distortion: list[str]) -> np.float64: ...
 
 
+    def distortion_probability(self, true_sequence: list[str], distortion: list[str], params: tuple) -> np.float64:
+        """
+        Calculate the probability of `true_sequence` being distorted as `distortion` under the model parameters `params`.
+
+        Models which only implement `get_distortion_probability` can only be evaluated with their own parameters.
+        """
+        if tuple(params) != tuple(self.params):
+            raise NotImplementedError(
+                f"{type(self).__name__} does not implement `distortion_probability`, so it can only be used with its own parameters."
+            )
+
+        return self.get_distortion_probability(true_sequence, distortion)
+
+
     def _get_distortions_of_length(self, sequence: list[str], length: int) -> list[list[str]]:
         if length == len(sequence):
             return [sequence]
@@ -102,15 +136,10 @@ class LossyContextModel(ABC):
             All language sequences which contain all of the words in
             `distortion`. 
         """
-        reconstructions = []
-        for (reconstruction, _) in self.language:
-            if all([word in reconstruction for word in distortion]):
-                reconstructions.append(reconstruction)
-
-        return reconstructions
+        return self.language.get_reconstructions(distortion)
 
 
-    def calculate_processing_difficulty(self, sequence: list[str], verbose = False) -> np.float64:
+    def calculate_processing_difficulty(self, sequence: list[str], verbose = False, params: tuple | None = None) -> np.float64:
         """
         Calculate the predicted processing difficulty of the last word in `sequence`.
 
@@ -128,6 +157,9 @@ class LossyContextModel(ABC):
         verbose : bool (default `False`)
             Set to `True` for detailed output.
 
+        params : tuple | None (default `None`)
+            The model parameters, defaulting to `self.params`.
+
         Returns
         -------
         np.float64
@@ -137,12 +169,14 @@ class LossyContextModel(ABC):
         if len(sequence) == 1:
             return -np.log2(self.get_prob(sequence))
 
+        params = self.params if params is None else params
+
         print_if_true(f"True context: {' '.join(sequence[:-1])}", flag = verbose)
         target_word = sequence[-1]
         processing_difficulty = np.float64(0.0)
 
         # Iterate over all possible distortions r
-        for (distortion, probability) in self.get_distortions(sequence[:-1]):
+        for (distortion, probability) in self.get_distortions(sequence[:-1], params):
             # probability is p(r|c)
             print_if_true(f"Current distortion: {distortion}", flag = verbose)
             print_if_true(f"p(r|c) = {probability}", flag = verbose)
@@ -161,7 +195,7 @@ class LossyContextModel(ABC):
                 print_if_true(f" ## Possible reconstructed context: {' '.join(reconstruction)}", flag = verbose)
 
                 print_if_true(f" ## Reconstructing sentence as: {' '.join(reconstruction_with_target)}", flag = verbose)
-                distortion_probability = self.get_distortion_probability(reconstruction, distortion) # p(r|~c)
+                distortion_probability = self.distortion_probability(reconstruction, distortion, params) # p(r|~c)
                 print_if_true(f" ## p(r|~c) = {distortion_probability}", flag = verbose)
 
                 print_if_true(f" ## p_L(~c) = {context_probability}", flag = verbose)
@@ -182,7 +216,112 @@ class LossyContextModel(ABC):
         return processing_difficulty
 
 
-    def cache_calculate_processing_difficulty(self, sequence: list[str]) -> Callable[[], np.float64]:
+    def difficulty(self, sequence: list[str], params: tuple) -> np.float64:
+        """
+        Calculate the predicted processing difficulty of the last word in `sequence` under the model
+        parameters `params`, without changing the model, using the fastest method the model offers.
+        """
+        return self.calculate_processing_difficulty(sequence, params = params)
+
+
+    def difficulty_distribution(
+        self,
+        context: list[str],
+        params: tuple,
+        candidates: list[str] | None = None
+    ) -> dict[str, np.float64]:
+        """
+        Calculate the predicted processing difficulty of every candidate word following `context`
+        under the model parameters `params`, see `calculate_processing_difficulty_distribution`.
+        """
+        return self.calculate_processing_difficulty_distribution(context, candidates, params)
+
+
+    def get_vocabulary(self) -> list[str]:
+        """Return all words in the language, in the order they first occur."""
+        return self.language.get_vocabulary()
+
+
+    def calculate_processing_difficulty_distribution(
+        self,
+        context: list[str],
+        candidates: list[str] | None = None,
+        params: tuple | None = None
+    ) -> dict[str, np.float64]:
+        """
+        Calculate the predicted processing difficulty of every candidate word following `context`.
+
+        This gives the same values as calling `calculate_processing_difficulty` with `context + [word]`
+        for every candidate, but the distortions of the context, their reconstructions and the posterior
+        weights of the reconstructions are only found once. The expected probabilities E[p(w|~c)] of all
+        candidates are then the product of the distortion-by-reconstruction weight matrix with a
+        reconstruction-by-candidate table of next-word probabilities.
+
+        Args
+        ----
+        context : list[str]
+            A sequence of words from the grammar. If it is empty, the surprisal of each candidate
+            starting a sequence is returned.
+        candidates : list[str] | None (default `None`)
+            The words to calculate processing difficulty for. Defaults to the whole vocabulary
+            of the language.
+        params : tuple | None (default `None`)
+            The model parameters, defaulting to `self.params`.
+
+        Returns
+        -------
+        dict[str, np.float64]
+            The processing difficulty of each candidate.
+        """
+        if candidates is None:
+            candidates = self.get_vocabulary()
+
+        if len(context) == 0:
+            with np.errstate(divide = "ignore"):
+                return {word: -np.log2(self.get_prob([word])) for word in candidates}
+
+        params = self.params if params is None else params
+        distortions = [(distortion, probability)
+                       for (distortion, probability) in self.get_distortions(context, params)
+                       if probability != 0]
+
+        # weights[i, k] = p(~c_k)*p(r_i|~c_k) for every distortion r_i and reconstruction ~c_k
+        reconstruction_indices: dict[tuple[str, ...], int] = {}
+        reconstructions = []
+        rows = []
+        for (distortion, _) in distortions:
+            row = {}
+            for reconstruction in self.get_reconstructions(distortion):
+                key = tuple(reconstruction)
+                if key not in reconstruction_indices:
+                    reconstruction_indices[key] = len(reconstructions)
+                    reconstructions.append(reconstruction)
+
+                k = reconstruction_indices[key]
+                row[k] = row.get(k, np.float64(0.0)) + \
+                    self.get_prob(reconstruction) * self.distortion_probability(reconstruction, distortion, params)
+            rows.append(row)
+
+        weights = np.zeros((len(distortions), len(reconstructions)))
+        for (i, row) in enumerate(rows):
+            weights[i, list(row.keys())] = list(row.values())
+        weights /= weights.sum(axis = 1, keepdims = True)
+
+        # next_word_probs[k, j] = p(w_j|~c_k)
+        next_word_probs = np.zeros((len(reconstructions), len(candidates)))
+        for (k, reconstruction) in enumerate(reconstructions):
+            next_word_probs[k] = [self.get_prob(reconstruction + [word]) for word in candidates]
+            next_word_probs[k] /= self.get_prob(reconstruction)
+
+        distortion_probs = np.array([probability for (_, probability) in distortions])
+        with np.errstate(divide = "ignore"):
+            processing_difficulties = -np.log2(weights @ next_word_probs)
+        processing_difficulties = distortion_probs @ processing_difficulties
+
+        return dict(zip(candidates, processing_difficulties))
+
+
+    def cache_calculate_processing_difficulty(self, sequence: list[str]) -> Callable[[tuple | None], np.float64]:
         """
         Returns a function to calculate the processing difficulty of the given
         sequence.
@@ -198,9 +337,9 @@ class LossyContextModel(ABC):
 
         Returns
         -------
-        Callable[[], np.float64]
-            A function that takes no arguments and returns the processing difficulty
-            calculated with the parameters of the underlying `LossyContextModel`.
+        Callable[[tuple | None], np.float64]
+            A function that takes the model parameters (defaulting to those of the
+            underlying `LossyContextModel`) and returns the processing difficulty.
         """
         target_word = sequence[-1]
     
@@ -225,7 +364,8 @@ class LossyContextModel(ABC):
             context_probs_per_distortion.append(curr_context_probs)
             target_probs_per_distortion.append(curr_target_probs)
 
-        def _processing_difficulty() -> np.float64:
+        def _processing_difficulty(params: tuple | None = None) -> np.float64:
+            params = self.params if params is None else params
             processing_difficulty = np.float64(0.0)
             for (distortion, reconstructions, context_probs, target_probs) in \
                 zip(distortions,
@@ -233,7 +373,7 @@ class LossyContextModel(ABC):
                     context_probs_per_distortion,
                     target_probs_per_distortion):
 
-                true_distortion_probability = self.get_distortion_probability(sequence[:-1], distortion)
+                true_distortion_probability = self.distortion_probability(sequence[:-1], distortion, params)
 
                 if true_distortion_probability == 0:
                     continue
@@ -241,7 +381,7 @@ class LossyContextModel(ABC):
                 average_prob = np.float64(0.0)
                 normaliser = np.float64(0.0)
                 for (reconstruction, context_probability, target_probability) in zip(reconstructions, context_probs, target_probs):
-                    reconstruction_distortion_probability = self.get_distortion_probability(reconstruction, distortion)
+                    reconstruction_distortion_probability = self.distortion_probability(reconstruction, distortion, params)
 
                     average_prob += context_probability * reconstruction_distortion_probability * target_probability
                     normaliser += context_probability * reconstruction_distortion_probability
@@ -253,8 +393,19 @@ class LossyContextModel(ABC):
         
         return _processing_difficulty
 
-    def calculate_sequence_processing_difficulty(self, sequence: list[str]) -> np.array:
-        return np.array([self.calculate_processing_difficulty(sequence[:i+1]) for i in range(len(sequence))])
+    def calculate_sequence_processing_difficulty(self, sequence: list[str], params: tuple | None = None) -> np.array:
+        return np.array([self.calculate_processing_difficulty(sequence[:i+1], params = params) for i in range(len(sequence))])
+
+
+class SimpleDeletionParams(NamedTuple):
+    """The parameters of `SimpleDeletionModel`."""
+    deletion_rate: np.float64
+
+
+class ProgressiveNoiseParams(NamedTuple):
+    """The parameters of `ProgressiveNoiseModel`."""
+    delta: np.float64 # max retention probability
+    nu: np.float64    # rate falloff
 
 
 class SimpleDeletionModel(LossyContextModel):
@@ -262,13 +413,21 @@ class SimpleDeletionModel(LossyContextModel):
     A simple implementation with a memory model which removes
     words randomly with probability `deletion_rate`.
     """
-    def __init__(self, grammar: PCFG, deletion_rate: float, max_depth: int = None):
+    def __init__(self, grammar: "PCFG", deletion_rate: float, max_depth: int = None):
         super().__init__(grammar, max_depth = max_depth)
 
         self.deletion_rate = np.float64(deletion_rate)
 
+    @property
+    def params(self) -> SimpleDeletionParams:
+        return SimpleDeletionParams(self.deletion_rate)
+
     def get_distortion_probability(self, true_sequence: list[str], distortion: list[str]) -> np.float64:
-        return self.deletion_rate**(len(true_sequence) - len(distortion)) * (1-self.deletion_rate)**len(distortion)
+        return self.distortion_probability(true_sequence, distortion, self.params)
+
+    def distortion_probability(self, true_sequence: list[str], distortion: list[str], params: tuple) -> np.float64:
+        (deletion_rate,) = params
+        return deletion_rate**(len(true_sequence) - len(distortion)) * (1-deletion_rate)**len(distortion)
 
 
 class SurprisalModel(LossyContextModel):
@@ -276,10 +435,17 @@ class SurprisalModel(LossyContextModel):
     A surprisal model implemented as a special case of
     lossy-context surprisal with no loss of information.
     """
-    def __init__(self, grammar: PCFG, max_depth: int = None):
+    def __init__(self, grammar: "PCFG", max_depth: int = None):
         super().__init__(grammar, max_depth = max_depth)
 
+    @property
+    def params(self) -> tuple:
+        return ()
+
     def get_distortion_probability(self, true_sequence: list[str], distortion: list[str]) -> np.float64:
+        return self.distortion_probability(true_sequence, distortion, self.params)
+
+    def distortion_probability(self, true_sequence: list[str], distortion: list[str], params: tuple) -> np.float64:
         return np.float64(1.0 if distortion == true_sequence else 0.0)
 
 
@@ -291,28 +457,383 @@ class ProgressiveNoiseModel(LossyContextModel):
 
     `max_retention_probability*rate_falloff**(i-j)`
     """
-    def __init__(self, grammar: PCFG, max_retention_probability: float, rate_falloff: float, max_depth: int = None):
+    def __init__(self, grammar: "PCFG", max_retention_probability: float, rate_falloff: float, max_depth: int = None):
         super().__init__(grammar, max_depth = max_depth)
 
         self.max_retention_probability = np.float64(max_retention_probability)
         self.rate_falloff = np.float64(rate_falloff)
 
+    @property
+    def params(self) -> ProgressiveNoiseParams:
+        return ProgressiveNoiseParams(self.max_retention_probability, self.rate_falloff)
+
     def get_distortion_probability(self, true_sequence: list[str], distortion: list[str]) -> np.float64:
+        return self.distortion_probability(true_sequence, distortion, self.params)
+
+    def distortion_probability(self, true_sequence: list[str], distortion: list[str], params: tuple) -> np.float64:
+        (max_retention_probability, rate_falloff) = params
         prob = np.float64(1.0)
         for (i, word) in enumerate(true_sequence):
             steps_back = len(true_sequence) - (i+1)
-            retention_probability = self.max_retention_probability*self.rate_falloff**steps_back
+            retention_probability = max_retention_probability*rate_falloff**steps_back
             if word in distortion:
                 prob *= retention_probability
             else:
                 prob *= 1-retention_probability
 
         return prob
-    
-    
+
+
+    def difficulty(self, sequence: list[str], params: tuple) -> np.float64:
+        """
+        Calculate the predicted processing difficulty of the last word in `sequence` under the model
+        parameters `params` with `calculate_processing_difficulty_dp`, without changing the model.
+        """
+        return self.calculate_processing_difficulty_dp(sequence, params)
+
+
+    def calculate_processing_difficulty_dp(self, sequence: list[str], params: tuple | None = None) -> np.float64:
+        """
+        Calculate the predicted processing difficulty of the last word in `sequence` with a dynamic
+        program over the language instead of pairing every distortion with every reconstruction.
+
+        Gives the same result as `calculate_processing_difficulty`. Distortions with the same set of
+        words share their reconstructions and their value of p(r|~c), so they are handled together.
+        For a fixed distortion r, p(r|~c) is a product over the words of ~c with retention
+        probabilities depending on how far each is from the end of ~c. It is therefore computed for
+        all reconstructions at once in one pass over `language.SuffixTrie`, the trie of reversed
+        sequences, which also counts how many distinct words of r have been seen along each path to
+        tell which sequences are reconstructions of r. All distinct distortions are handled in the
+        same pass.
+
+        Args
+        ----
+        sequence : list[str]
+            A sequence of words from the grammar, with the last being the word for which
+            processing difficulty is calculated.
+        params : tuple | None (default `None`)
+            The model parameters, defaulting to `self.params`.
+
+        Returns
+        -------
+        np.float64
+            The processing difficulty.
+        """
+        if len(sequence) == 1:
+            return -np.log2(self.get_prob(sequence))
+
+        params = self.params if params is None else params
+        target_word = sequence[-1]
+
+        # p(r|c) summed over all distortions r with the same set of words
+        word_set_probs: dict[frozenset[str], np.float64] = {}
+        for (distortion, probability) in self.get_distortions(sequence[:-1], params):
+            if probability == 0:
+                continue
+            words = frozenset(distortion)
+            word_set_probs[words] = word_set_probs.get(words, np.float64(0.0)) + probability
+
+        word_sets = list(word_set_probs)
+        average_probs = self._get_average_target_probs(word_sets, self._get_target_probs(target_word), params)
+        probabilities = np.array([word_set_probs[words] for words in word_sets])
+
+        return np.sum(-np.log2(average_probs) * probabilities)
+
+
+    def calculate_sequence_processing_difficulty_windowed(
+        self,
+        sequence: list[str],
+        window: int,
+        params: tuple | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Calculate the predicted processing difficulty of every word in `sequence`, conditioning each
+        only on the last `window` words before it instead of on everything before it.
+
+        Distortions of the whole preceding context are exponential in its length, while a word
+        `steps_back` steps back is only retained with probability `delta*nu**steps_back`. The words
+        before the window are therefore treated as lost, which for a context of n words happens with
+        probability prod[1 - delta*nu**s] over s = window, ..., n-1. The rest, the probability that any
+        of them would have been retained, is returned as the lost mass of each word.
+
+        E[p(w|~c)] only depends on the set of words of a distortion and on the target word, so it is
+        cached for the whole sequence and mostly reused as the window slides along, making the time
+        linear in the length of `sequence`.
+
+        Args
+        ----
+        sequence : list[str]
+            A sequence of words from the grammar, e.g. a whole text.
+        window : int
+            The number of words of context, at least 1.
+        params : tuple | None (default `None`)
+            The model parameters, defaulting to `self.params`.
+
+        Returns
+        -------
+        tuple[np.ndarray, np.ndarray]
+            The processing difficulty of every word and the probability mass lost by truncating its context.
+        """
+        if window < 1:
+            raise ValueError("The window has to contain at least one word.")
+
+        params = self.params if params is None else params
+        (max_retention_probability, rate_falloff) = params
+
+        # -log2(E[p(w|~c)]) keyed by (set of words of the distortion, target word)
+        surprisals: dict[tuple[frozenset[str], str], np.float64] = {}
+        target_probs: dict[str, np.ndarray] = {}
+
+        difficulties = np.zeros(len(sequence))
+        lost_masses = np.zeros(len(sequence))
+        for i in range(len(sequence)):
+            if i == 0:
+                difficulties[i] = -np.log2(self.get_prob(sequence[:1]))
+                continue
+
+            target_word = sequence[i]
+            word_set_probs: dict[frozenset[str], np.float64] = {}
+            for (distortion, probability) in self.get_distortions(sequence[max(0, i - window):i], params):
+                if probability == 0:
+                    continue
+                words = frozenset(distortion)
+                word_set_probs[words] = word_set_probs.get(words, np.float64(0.0)) + probability
+
+            new_word_sets = [words for words in word_set_probs if (words, target_word) not in surprisals]
+            if new_word_sets:
+                if target_word not in target_probs:
+                    target_probs[target_word] = self._get_target_probs(target_word)
+                average_probs = self._get_average_target_probs(new_word_sets, target_probs[target_word], params)
+                for (words, average_prob) in zip(new_word_sets, average_probs):
+                    surprisals[(words, target_word)] = -np.log2(average_prob)
+
+            difficulties[i] = sum(surprisals[(words, target_word)] * probability for (words, probability) in word_set_probs.items())
+            lost_masses[i] = 1 - np.prod(1 - max_retention_probability*rate_falloff**np.arange(window, i))
+
+        return (difficulties, lost_masses)
+
+
+    def _get_target_probs(self, target_word: str) -> np.ndarray:
+        """Return p(w|~c) of `target_word` for every sequence ~c of the language, in language order."""
+        return np.array([
+            self.get_prob(reconstruction + [target_word]) for (reconstruction, _) in self.language
+        ]) / self.language.get_suffix_trie().sequence_probs
+
+
+    def _get_reconstruction_mask(self, word_sets: list[frozenset[str]]) -> tuple[list[np.ndarray], np.ndarray]:
+        """
+        Return for every level of the suffix trie whether the word of each node is in each set of words r
+        in `word_sets`, and for every sequence of the language whether it is a reconstruction of each r.
+        """
+        trie = self.language.get_suffix_trie()
+
+        # membership[v, s] is whether word v is in distortion s; words outside the language
+        # make a distortion impossible to reconstruct, as in `get_reconstructions`
+        membership = np.zeros((len(trie.vocabulary), len(word_sets)), dtype = bool)
+        word_set_sizes = np.zeros(len(word_sets), dtype = np.int64)
+        for (s, words) in enumerate(word_sets):
+            word_set_sizes[s] = len(words)
+            for word in words:
+                if word in trie.word_ids:
+                    membership[trie.word_ids[word], s] = True
+
+        # the number of distinct words of r along the path to every node, with the root as the extra last row
+        level_membership = [membership[trie.words[level]] for level in trie.levels]
+        matched_words = np.zeros((len(trie) + 1, len(word_sets)), dtype = np.int64)
+        for (level, in_distortion) in zip(trie.levels, level_membership):
+            matched_words[level] = matched_words[trie.parents[level]] + (in_distortion & trie.new_word[level, np.newaxis])
+
+        return (level_membership, matched_words[trie.sequence_nodes] == word_set_sizes)
+
+
+    def _get_average_target_probs(self, word_sets: list[frozenset[str]], target_probs: np.ndarray, params: tuple) -> np.ndarray:
+        """
+        Return E[p(w|~c)] over the reconstructions ~c of every set of words r in `word_sets`,
+        given p(w|~c) for every sequence of the language as `target_probs`.
+        """
+        (max_retention_probability, rate_falloff) = params
+        trie = self.language.get_suffix_trie()
+        (level_membership, is_reconstruction) = self._get_reconstruction_mask(word_sets)
+
+        # p(r|~c) for every node and distortion, with an extra last row for the root so that
+        # the parent index -1 refers to it
+        distortion_probs = np.ones((len(trie) + 1, len(word_sets)))
+        for (steps_back, (level, in_distortion)) in enumerate(zip(trie.levels, level_membership)):
+            retention_probability = max_retention_probability*rate_falloff**steps_back
+            distortion_probs[level] = distortion_probs[trie.parents[level]] * \
+                np.where(in_distortion, retention_probability, 1-retention_probability)
+
+        # the terms p(~c)*p(r|~c) of every sequence ~c of the language which is a reconstruction of r
+        weights = np.where(is_reconstruction, trie.sequence_probs[:, np.newaxis] * distortion_probs[trie.sequence_nodes], 0.0)
+
+        # sum[p(~c)*p(r|~c)*p(w|~c)]/sum[p(r|~c)*p(~c)]
+        return (target_probs @ weights) / weights.sum(axis = 0)
+
+
+    def cache_calculate_processing_difficulty_gradient(
+        self,
+        sequence: list[str]
+    ) -> Callable[[tuple], tuple[np.float64, np.ndarray]]:
+        """
+        Precompute everything `calculate_processing_difficulty_dp` needs that does not depend on the
+        model parameters, and return a function calculating the processing difficulty of the last word
+        in `sequence` together with its gradient with respect to the parameters.
+
+        The derivatives of the retention probabilities are carried through the products giving
+        p(r|c) and p(r|~c) along with their values, so the gradient is exact and stays finite where
+        a retention probability is 0 or 1. As in `calculate_processing_difficulty`, only distortions
+        r with p(r|c) > 0 contribute.
+
+        Args
+        ----
+        sequence : list[str]
+            A sequence of words from the grammar, with the last being the word for which
+            processing difficulty is calculated.
+
+        Returns
+        -------
+        Callable[[tuple], tuple[np.float64, np.ndarray]]
+            A function taking the model parameters and returning the processing difficulty and
+            its derivatives with respect to `delta` and `nu`, in that order.
+        """
+        if len(sequence) == 1:
+            difficulty = -np.log2(self.get_prob(sequence))
+            return lambda params: (difficulty, np.zeros(2))
+
+        context = sequence[:-1]
+        target_word = sequence[-1]
+
+        # every distortion r of the context, as which words of the context it keeps and its set of words
+        word_set_ids: dict[frozenset[str], int] = {}
+        distortion_word_sets = []
+        kept = []
+        for length in range(len(context), -1, -1):
+            for distortion in self._get_distortions_of_length(context, length):
+                distortion_word_sets.append(word_set_ids.setdefault(frozenset(distortion), len(word_set_ids)))
+                kept.append([word in distortion for word in context])
+
+        distortion_word_sets = np.array(distortion_word_sets, dtype = np.int64)
+        kept = np.array(kept, dtype = bool)
+        context_steps_back = np.arange(len(context) - 1, -1, -1)
+
+        word_sets = list(word_set_ids)
+        trie = self.language.get_suffix_trie()
+        (level_membership, is_reconstruction) = self._get_reconstruction_mask(word_sets)
+        nodes = trie.sequence_nodes
+        target_probs = self._get_target_probs(target_word)
+
+        def _retention(steps_back, max_retention_probability, rate_falloff):
+            # the retention probability and its derivatives with respect to delta and nu
+            retention_probability = max_retention_probability*rate_falloff**steps_back
+            derivatives = np.stack([
+                rate_falloff**steps_back,
+                steps_back*max_retention_probability*rate_falloff**np.maximum(steps_back - 1, 0)
+            ])
+            return (retention_probability, derivatives)
+
+        def _processing_difficulty_gradient(params: tuple) -> tuple[np.float64, np.ndarray]:
+            (max_retention_probability, rate_falloff) = params
+
+            # p(r|c) of every distortion, multiplied in the same order as `distortion_probability`
+            (retention_probabilities, retention_derivatives) = _retention(context_steps_back, max_retention_probability, rate_falloff)
+            factors = np.where(kept, retention_probabilities, 1-retention_probabilities)
+            factor_derivatives = np.where(kept, retention_derivatives[:, np.newaxis], -retention_derivatives[:, np.newaxis])
+            probs = np.ones(len(kept))
+            prob_derivatives = np.zeros((2, len(kept)))
+            for i in range(len(context)):
+                prob_derivatives = prob_derivatives*factors[:, i] + probs*factor_derivatives[:, :, i]
+                probs = probs*factors[:, i]
+
+            # summed over all distortions with the same set of words
+            set_probs = np.bincount(distortion_word_sets, weights = probs, minlength = len(word_sets))
+            set_prob_derivatives = np.stack([
+                np.bincount(distortion_word_sets, weights = derivatives, minlength = len(word_sets))
+                for derivatives in prob_derivatives
+            ])
+
+            # p(r|~c) for every node and word set, with the root as the extra last row
+            distortion_probs = np.ones((len(trie) + 1, len(word_sets)))
+            distortion_prob_derivatives = np.zeros((2, len(trie) + 1, len(word_sets)))
+            for (steps_back, (level, in_distortion)) in enumerate(zip(trie.levels, level_membership)):
+                (retention_probability, retention_derivative) = _retention(steps_back, max_retention_probability, rate_falloff)
+                factors = np.where(in_distortion, retention_probability, 1-retention_probability)
+                factor_derivatives = np.where(in_distortion, retention_derivative[:, np.newaxis, np.newaxis], -retention_derivative[:, np.newaxis, np.newaxis])
+                parents = trie.parents[level]
+
+                distortion_prob_derivatives[:, level] = distortion_prob_derivatives[:, parents]*factors + \
+                    distortion_probs[parents]*factor_derivatives
+                distortion_probs[level] = distortion_probs[parents]*factors
+
+            weights = np.where(is_reconstruction, trie.sequence_probs[:, np.newaxis] * distortion_probs[nodes], 0.0)
+            weight_derivatives = np.where(is_reconstruction, trie.sequence_probs[:, np.newaxis] * distortion_prob_derivatives[:, nodes], 0.0)
+
+            # E[p(w|~c)] = sum[p(~c)*p(r|~c)*p(w|~c)]/sum[p(r|~c)*p(~c)] for the word sets with p(r|c) > 0
+            used = set_probs != 0
+            numerators = (target_probs @ weights)[used]
+            normalisers = weights.sum(axis = 0)[used]
+            surprisals = -np.log2(numerators / normalisers)
+            surprisal_derivatives = -((target_probs @ weight_derivatives)[:, used] / numerators
+                                      - weight_derivatives.sum(axis = 1)[:, used] / normalisers) / np.log(2)
+
+            difficulty = np.sum(surprisals * set_probs[used])
+            gradient = set_prob_derivatives[:, used] @ surprisals + surprisal_derivatives @ set_probs[used]
+            return (difficulty, gradient)
+
+        return _processing_difficulty_gradient
+
+
+    def difficulty_and_gradient(self, sequence: list[str], params: tuple) -> tuple[np.float64, np.ndarray]:
+        """
+        Calculate the predicted processing difficulty of the last word in `sequence` and its gradient
+        with respect to `delta` and `nu`, see `cache_calculate_processing_difficulty_gradient`.
+        """
+        return self.cache_calculate_processing_difficulty_gradient(sequence)(params)
+
+
+    # the setters change the parameters used when none are given explicitly, which is not thread-safe
     def set_max_retention_probability(self, max_retention_probability: np.float64):
         self.max_retention_probability = max_retention_probability
 
 
     def set_rate_falloff(self, rate_falloff: np.float64):
-        self.rate_falloff = rate_falloff
\ No newline at end of file
+        self.rate_falloff = rate_falloff
+
+
+# the models by the names used by `cli` and `server`
+MODELS = {
+    "progressive": ProgressiveNoiseModel,
+    "deletion": SimpleDeletionModel,
+    "surprisal": SurprisalModel,
+}
+
+# names of the parameters each model takes, in the order of the constructor
+MODEL_PARAMETERS = {
+    "progressive": ["delta", "nu"],
+    "deletion": ["deletion_rate"],
+    "surprisal": [],
+}
+
+
+def get_parameters(model_name: str, values: dict) -> tuple:
+    """Collect the parameters of the model `model_name` from `values`, in the order the model takes them."""
+    return tuple(np.float64(values[parameter]) for parameter in MODEL_PARAMETERS[model_name])
+
+
+if __name__ == "__main__":
+    # check that the dynamic program agrees with the direct calculation on the grammars of the thesis
+    import grammars
+
+    for name in grammars.GRAMMARS:
+        model = ProgressiveNoiseModel(grammars.get_language(name), 0.6, 0.9)
+        max_error = 0.0
+        for (sequence, _) in model.language:
+            if len(sequence) < 2:
+                continue
+            for (delta, nu) in [(0.6, 0.9), (0.3, 0.5), (0.9, 0.2), (1.0, 1.0)]:
+                model.set_max_retention_probability(np.float64(delta))
+                model.set_rate_falloff(np.float64(nu))
+                max_error = max(max_error, abs(
+                    model.calculate_processing_difficulty(sequence) - model.calculate_processing_difficulty_dp(sequence)
+                ))
+
+        print(f"{name}: largest difference {max_error}")
@@ -1,11 +1,12 @@
-from nltk.grammar import PCFG
 import numpy as np
 from abc import ABC, abstractmethod
-from language import generate_language
-from typing import Callable
-import pytensor.tensor as pt
-from pytensor.tensor import TensorVariable
-from pytensor import ifelse
+from language import Language
+from typing import TYPE_CHECKING, Callable
+
+# pytensor is only imported once a graph is built
+if TYPE_CHECKING:
+    from nltk.grammar import PCFG
+    from pytensor.tensor import TensorVariable
 
 def print_if_true(text, flag):
     if flag:
@@ -23,23 +24,26 @@ class LossyContextModel(ABC):
     To implement the class the method `get_distortion_probability` has to be specified, which returns
     the probability of a sequence `true_sequence` being distorted as a certain other sequence `distortion`.
     A distortion is the true context with zero or more words removed.
+    For the PyTensor graphs, `compute_retention_graph` has to be specified as well, giving the
+    probability of a word being retained by how many steps back from the end of the sequence it is.
+
+    Instead of a grammar, an already generated `language.Language` can be given, which is then
+    shared with all other models using it, or a language as returned by `language.generate_language`.
 
-    The argument `max_depth` is passed to `nltk.parse.generate.generate`.
+    The argument `max_depth` is passed to `language.generate_language`.
     """
-    def __init__(self, language: PCFG | list, max_depth: int | None = None):
-        if type(language) == PCFG:
-            self.language = generate_language(language, max_depth)
-        else:
+    def __init__(self, language: "PCFG | Language | list", max_depth: int | None = None):
+        if isinstance(language, Language):
             self.language = language
+        elif isinstance(language, list):
+            self.language = Language(language)
+        else:
+            self.language = Language.from_grammar(language, max_depth)
 
 
     def get_prob(self, sequence: list[str]) -> np.float64:
         """Calculate the a priori probability of `sequence` [p_L(sequence)]."""
-        for (language_sequence, probability) in self.language:
-            if language_sequence == sequence:
-                return probability
-            
-        return np.float64(0.0)
+        return self.language.get_prob(sequence)
     
     def get_conditional_prob(self, sequence: list[str]) -> np.float64:
         """Calculate the conditional probability of `sequence[-1]` given `sequence[:-1]`."""
@@ -73,10 +77,8 @@ class LossyContextModel(ABC):
     def get_distortion_probability(self, true_sequence: list[str], distortion: list[str]) -> np.float64: ...
 
     @abstractmethod
-    def compute_distortion_graph(self,
-                                 true_sequence: list[str],
-                                 distortion: list[str],
-                                 *model_params) -> TensorVariable: ...
+    def compute_retention_graph(self, steps_back: np.ndarray, *model_params) -> "TensorVariable":
+        """The probability of retaining a word `steps_back` steps back from the last word of a sequence."""
 
 
     def _get_distortions_of_length(self, sequence: list[str], length: int) -> list[list[str]]:
@@ -112,12 +114,7 @@ class LossyContextModel(ABC):
             All language sequences which contain all of the words in
             `distortion`. 
         """
-        reconstructions = []
-        for (reconstruction, _) in self.language:
-            if all([word in reconstruction for word in distortion]):
-                reconstructions.append(reconstruction)
-
-        return reconstructions
+        return self.language.get_reconstructions(distortion)
 
 
     def calculate_processing_difficulty(self, sequence: list[str], verbose = False) -> np.float64:
@@ -264,46 +261,126 @@ class LossyContextModel(ABC):
         return _processing_difficulty
 
 
-    def cache_processing_difficulty_graph(self, sequence, *model_params) -> TensorVariable:
-        if len(sequence) == 1:
-            return pt.as_tensor_variable(-np.log2(self.get_prob(sequence)))
-        
-        target_word = sequence[-1]
-        true_context = sequence[:-1]
-        processing_difficulty = np.float64(0.0)
-        for (true_context_distortion, _) in self.get_distortions(true_context):
-            true_distortion_probability = self.compute_distortion_graph(
-                true_context,
-                true_context_distortion,
-                *model_params
-            )
+    def get_processing_difficulty_arrays(self, sequence: list[str]) -> dict[str, np.ndarray]:
+        """
+        Collect everything about `sequence` that `cache_processing_difficulty_graph` needs as arrays.
 
+        Distortions with the same set of words share their reconstructions and the value of p(r|~c),
+        so they are grouped by their set of words. Positions in a sequence are counted in steps back
+        from its last word.
 
-            average_prob = np.float64(0.0)
-            normaliser = np.float64(0.0)
+        Args
+        ----
+        sequence : list[str]
+            A sequence of words from the grammar, with at least two words.
 
-            for reconstruction in self.get_reconstructions(true_context_distortion):
-                reconstruction_with_target = reconstruction + [target_word]
-                rec_context_probability = self.get_prob(reconstruction)
-                target_probability = self.get_prob(reconstruction_with_target)/rec_context_probability
+        Returns
+        -------
+        dict[str, np.ndarray]
+            `context_steps_back` (m,): the steps back of each word of the context;
+            `kept` (n_distortions, m): which words of the context each distortion keeps;
+            `word_sets` (n_distortions, n_word_sets): the set of words of each distortion, one-hot;
+            `reconstruction_words` (n_word_sets, n_reconstructions, max_length): whether the word of
+            each reconstruction at each position is in each set of words;
+            `reconstruction_positions` (n_reconstructions, max_length): which positions a reconstruction has;
+            `context_probs` (n_word_sets, n_reconstructions): p(~c) where ~c is a reconstruction of the set
+            of words and 0 otherwise;
+            `target_probs` (n_reconstructions,): p(w|~c).
+        """
+        target_word = sequence[-1]
+        context = sequence[:-1]
 
-                rec_distortion_probability = self.compute_distortion_graph(
-                    reconstruction,
-                    true_context_distortion,
-                    *model_params
-                )
-                
+        word_set_ids: dict[frozenset[str], int] = {}
+        distortion_word_sets = []
+        kept = []
+        for (distortion, _) in self.get_distortions(context):
+            distortion_word_sets.append(word_set_ids.setdefault(frozenset(distortion), len(word_set_ids)))
+            kept.append([word in distortion for word in context])
 
-                average_prob += rec_context_probability * rec_distortion_probability * target_probability
-                normaliser += rec_context_probability * rec_distortion_probability
+        word_sets = list(word_set_ids)
+        reconstructions_per_word_set = [self.get_reconstructions(list(words)) for words in word_sets]
 
-            average_prob /= normaliser
-            processing_difficulty += ifelse(true_distortion_probability > 0.0, -pt.log2(average_prob) * true_distortion_probability, np.float64(0.0))
+        # every sequence of the language which is a reconstruction of any of the sets of words
+        reconstruction_ids: dict[tuple[str, ...], int] = {}
+        for reconstructions in reconstructions_per_word_set:
+            for reconstruction in reconstructions:
+                reconstruction_ids.setdefault(tuple(reconstruction), len(reconstruction_ids))
+        reconstructions = [list(reconstruction) for reconstruction in reconstruction_ids]
+        max_length = max((len(reconstruction) for reconstruction in reconstructions), default = 0)
+
+        reconstruction_words = np.zeros((len(word_sets), len(reconstructions), max_length), dtype = bool)
+        reconstruction_positions = np.zeros((len(reconstructions), max_length), dtype = bool)
+        for (n, reconstruction) in enumerate(reconstructions):
+            reconstruction_positions[n, :len(reconstruction)] = True
+            for (steps_back, word) in enumerate(reversed(reconstruction)):
+                for (s, words) in enumerate(word_sets):
+                    reconstruction_words[s, n, steps_back] = word in words
+
+        context_probs = np.zeros((len(word_sets), len(reconstructions)))
+        for (s, reconstructions_of_set) in enumerate(reconstructions_per_word_set):
+            for reconstruction in reconstructions_of_set:
+                context_probs[s, reconstruction_ids[tuple(reconstruction)]] += self.get_prob(reconstruction)
+
+        return {
+            "context_steps_back": np.arange(len(context) - 1, -1, -1),
+            "kept": np.array(kept, dtype = bool),
+            "word_sets": np.eye(len(word_sets))[distortion_word_sets],
+            "reconstruction_words": reconstruction_words,
+            "reconstruction_positions": reconstruction_positions,
+            "context_probs": context_probs,
+            "target_probs": np.array([
+                self.get_prob(reconstruction + [target_word])/self.get_prob(reconstruction)
+                for reconstruction in reconstructions
+            ]),
+        }
+
+
+    def cache_processing_difficulty_graph(self, sequence, *model_params) -> "TensorVariable":
+        """
+        Generates a PyTensor `TensorVariable` for the processing difficulty of the last word in `sequence`.
 
-        return processing_difficulty
+        The graph is built from a few operations on the arrays of `get_processing_difficulty_arrays`
+        rather than from one scalar operation per distortion and reconstruction, so the number of
+        operations in the graph does not grow with the number of reconstructions.
+        """
+        import pytensor.tensor as pt
 
+        if len(sequence) == 1:
+            return pt.as_tensor_variable(-np.log2(self.get_prob(sequence)))
 
-    def processing_difficulty(self, sequences: list[list[str]], *model_params) -> TensorVariable:
+        arrays = self.get_processing_difficulty_arrays(sequence)
+
+        # p(r|c) of every distortion, summed over the distortions with the same set of words
+        retention_probabilities = self.compute_retention_graph(arrays["context_steps_back"], *model_params)
+        true_distortion_probabilities = pt.prod(
+            pt.switch(arrays["kept"], retention_probabilities, 1 - retention_probabilities),
+            axis = 1
+        )
+        word_set_probabilities = pt.dot(true_distortion_probabilities, arrays["word_sets"])
+
+        # p(~c)*p(r|~c) of every reconstruction ~c of every set of words r
+        max_length = arrays["reconstruction_positions"].shape[1]
+        retention_probabilities = self.compute_retention_graph(np.arange(max_length), *model_params)
+        rec_distortion_probabilities = pt.prod(
+            pt.switch(
+                arrays["reconstruction_positions"],
+                pt.switch(arrays["reconstruction_words"], retention_probabilities, 1 - retention_probabilities),
+                np.float64(1.0)
+            ),
+            axis = 2
+        )
+        weights = arrays["context_probs"] * rec_distortion_probabilities
+
+        # sum[p(~c)*p(r|~c)*p(w|~c)]/sum[p(r|~c)*p(~c)], only for the sets of words with p(r|c) > 0 so
+        # that the others contribute neither a value nor (through a zero normaliser) a gradient
+        possible = word_set_probabilities > 0.0
+        average_probs = pt.switch(possible, pt.dot(weights, arrays["target_probs"]), np.float64(1.0)) / \
+            pt.switch(possible, weights.sum(axis = 1), np.float64(1.0))
+
+        return pt.sum(pt.switch(possible, -pt.log2(average_probs) * word_set_probabilities, np.float64(0.0)))
+
+
+    def processing_difficulty(self, sequences: list[list[str]], *model_params) -> "TensorVariable":
         """
         Generates a PyTensor `TensorVariable` for calculating the estimated processing difficulty
         for each of the sequences in `sequences` using the model parameters given.
@@ -315,7 +392,7 @@ class LossyContextModel(ABC):
 
         *model_params
             The model parameters as tensor variables to be passed onto
-            `cache_processing_difficulty_graph` and then `compute_distortion_graph`.
+            `cache_processing_difficulty_graph` and then `compute_retention_graph`.
 
         Returns
         -------
@@ -323,6 +400,8 @@ class LossyContextModel(ABC):
             A `TensorVariable` calculating processing difficulty for each
             sequence.
         """
+        import pytensor.tensor as pt
+
         return pt.as_tensor_variable([
             self.cache_processing_difficulty_graph(sequence, *model_params)
             for sequence in sequences
@@ -341,7 +420,7 @@ class ProgressiveNoiseModel(LossyContextModel):
 
     `delta*nu**(i-j)`
     """
-    def __init__(self, grammar: PCFG, delta: float, nu: float, max_depth: int = None):
+    def __init__(self, grammar: "PCFG", delta: float, nu: float, max_depth: int = None):
         super().__init__(grammar, max_depth = max_depth)
 
         self.delta = np.float64(delta)
@@ -361,25 +440,11 @@ class ProgressiveNoiseModel(LossyContextModel):
         return prob
 
 
-    def compute_distortion_graph(
-        self,
-        true_sequence: list[str],
-        distortion: list[str],
-        *model_params
-    ) -> TensorVariable:
+    def compute_retention_graph(self, steps_back: np.ndarray, *model_params) -> "TensorVariable":
         delta = model_params[0]
         nu = model_params[1]
 
-        prob = np.float64(1.0)
-        for (i, word) in enumerate(true_sequence):
-            steps_back = len(true_sequence) - (i+1)
-            retention_probability = delta*nu**steps_back
-            if word in distortion:
-                prob *= retention_probability
-            else:
-                prob *= 1-retention_probability
-
-        return prob
+        return delta*nu**steps_back
 
 
     def set_delta(self, delta: np.float64):
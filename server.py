@@ -0,0 +1,351 @@
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import grammars
+import lossy
+from language import Language
+from lossy import MODELS, MODEL_PARAMETERS, get_parameters
+
+# the number of models each (worker) process keeps warm
+MAX_MODELS = 8
+
+# models of the current (worker) process, keyed by (grammar, model name, max depth)
+_models: OrderedDict = OrderedDict()
+# languages shared by the models above, keyed by (grammar, max depth)
+_languages: OrderedDict = OrderedDict()
+
+
+def _get_language(grammar: str, max_depth: int | None) -> Language:
+    key = (grammar, max_depth)
+    if key in _languages:
+        _languages.move_to_end(key)
+        return _languages[key]
+
+    from nltk.grammar import PCFG
+
+    _languages[key] = Language.from_grammar(PCFG.fromstring(grammar), max_depth)
+    if len(_languages) > MAX_MODELS:
+        _languages.popitem(last = False)
+
+    return _languages[key]
+
+
+def _get_model(grammar: str, model_name: str, max_depth: int | None) -> lossy.LossyContextModel:
+    key = (grammar, model_name, max_depth)
+    if key in _models:
+        _models.move_to_end(key)
+        return _models[key]
+
+    parameters = [0.0] * len(MODEL_PARAMETERS[model_name])
+    _models[key] = MODELS[model_name](_get_language(grammar, max_depth), *parameters)
+    if len(_models) > MAX_MODELS:
+        _models.popitem(last = False)
+
+    return _models[key]
+
+
+def _warm_models(keys: list[tuple[str, str, int | None]]):
+    for key in keys:
+        _get_model(*key)
+
+
+def score_batch(grammar: str, model_name: str, max_depth: int | None, items: list[dict]) -> list[float]:
+    """
+    Calculate processing difficulty for a batch of items sharing the same model.
+
+    The model is built on first use and kept warm in the calling process.
+
+    Args
+    ----
+    grammar : str
+        The PCFG in the format read by `nltk.grammar.PCFG.fromstring`.
+    model_name : str
+        One of the keys of `lossy.MODELS`.
+    max_depth : int | None
+        `max_depth` argument to `language.generate_language`.
+    items : list[dict]
+        The items to score, each with the key `sequence` and the model parameters.
+
+    Returns
+    -------
+    list[float]
+        The processing difficulty of each item.
+    """
+    model = _get_model(grammar, model_name, max_depth)
+
+    return [float(model.difficulty(item["sequence"], get_parameters(model_name, item))) for item in items]
+
+
+class RequestError(Exception):
+    """A malformed request, answered with status 400."""
+
+
+class DifficultyServer:
+    """
+    A local server answering processing difficulty queries over HTTP with JSON bodies.
+
+    `POST /difficulty` takes an object with the keys `grammar` (a grammar string, or
+    `grammar_name` naming one of `grammars.GRAMMARS` instead), `model`
+    (default `"progressive"`), `max_depth` (optional), the model parameters (e.g. `delta`
+    and `nu`) and either `sequence` (a list of words or a space-separated string) or
+    `sequences` (a list of such). It answers with `{"difficulty": ...}`, holding one value
+    per sequence, or `null` where it is not finite (e.g. for a word outside the grammar).
+    `GET /health` answers with `{"status": "ok"}`. Malformed requests are answered with
+    status 400 and `{"error": ...}`.
+
+    Requests for the same model arriving within `batch_window` seconds of each other are
+    sent to the executor together. Models are built once per executor process and kept warm,
+    so only the first request for a grammar pays for generating its language. If a worker
+    process dies, the requests in flight are answered with status 500 and the workers are
+    replaced (and warmed up again).
+
+    Args
+    ----
+    processes : int (default `1`)
+        The number of worker processes. With `0` everything is evaluated in a single
+        background thread of the server process.
+    batch_window : float (default `0.002`)
+        How long, in seconds, to collect requests for a batch.
+    max_batch_size : int (default `256`)
+        Batches are sent off as soon as they reach this size.
+    warm : list | None (default `None`)
+        (grammar, model name, max depth) triples to build in every worker on start-up.
+    """
+    def __init__(
+        self,
+        processes: int = 1,
+        batch_window: float = 0.002,
+        max_batch_size: int = 256,
+        warm: list[tuple[str, str, int | None]] | None = None
+    ):
+        self.processes = processes
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.warm = warm or []
+        self.executor = self._create_executor()
+
+        self._pending: dict[tuple, list[tuple[dict, asyncio.Future]]] = {}
+        self._server: asyncio.AbstractServer | None = None
+
+
+    def _create_executor(self) -> Executor:
+        if self.processes == 0:
+            # the model caches of this process are not locked, so they are only used from one thread
+            return ThreadPoolExecutor(1, initializer = _warm_models, initargs = (self.warm,))
+
+        # forked workers would inherit (and keep open) the sockets of client connections
+        return ProcessPoolExecutor(
+            self.processes,
+            mp_context = multiprocessing.get_context("spawn"),
+            initializer = _warm_models,
+            initargs = (self.warm,)
+        )
+
+
+    def _replace_broken_executor(self, executor: Executor):
+        # several batches may fail on the same broken pool, but only the first replaces it
+        if self.executor is executor:
+            executor.shutdown(wait = False, cancel_futures = True)
+            self.executor = self._create_executor()
+
+
+    async def difficulty(self, grammar: str, model_name: str, max_depth: int | None, item: dict) -> float:
+        """Queue a single item for the next batch of its model and wait for its result."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        key = (grammar, model_name, max_depth)
+
+        if key not in self._pending:
+            self._pending[key] = []
+            loop.call_later(self.batch_window, self._flush, key)
+
+        self._pending[key].append((item, future))
+        if len(self._pending[key]) >= self.max_batch_size:
+            self._flush(key)
+
+        return await future
+
+
+    def _flush(self, key: tuple):
+        batch = self._pending.pop(key, None)
+        if not batch:
+            return
+
+        items = [item for (item, _) in batch]
+        futures = [future for (_, future) in batch]
+        loop = asyncio.get_running_loop()
+        executor = self.executor
+
+        def _set_exception(exception: BaseException):
+            if isinstance(exception, BrokenProcessPool):
+                self._replace_broken_executor(executor)
+            for future in futures:
+                if not future.done():
+                    future.set_exception(exception)
+
+        def _set_results(result: asyncio.Future):
+            if result.exception() is not None:
+                _set_exception(result.exception())
+                return
+            for (i, future) in enumerate(futures):
+                if not future.done():
+                    future.set_result(result.result()[i])
+
+        # `_flush` runs as a callback, so an exception escaping it would leave the futures unresolved
+        try:
+            result = loop.run_in_executor(executor, score_batch, *key, items)
+        except Exception as e:
+            _set_exception(e)
+            return
+
+        result.add_done_callback(_set_results)
+
+
+    async def _handle_query(self, query: dict) -> dict:
+        if "grammar_name" in query:
+            if query["grammar_name"] not in grammars.GRAMMARS:
+                raise RequestError(f"Unknown grammar '{query['grammar_name']}'.")
+            query["grammar"] = grammars.GRAMMARS[query["grammar_name"]]()
+        elif "grammar" not in query:
+            raise RequestError("Missing 'grammar' or 'grammar_name'.")
+
+        model_name = query.get("model", "progressive")
+        if model_name not in MODELS:
+            raise RequestError(f"Unknown model '{model_name}'.")
+
+        parameters = {}
+        for parameter in MODEL_PARAMETERS[model_name]:
+            if parameter not in query:
+                raise RequestError(f"Missing parameter '{parameter}'.")
+            parameters[parameter] = float(query[parameter])
+
+        if "sequence" in query:
+            sequences = [query["sequence"]]
+        elif "sequences" in query:
+            sequences = query["sequences"]
+        else:
+            raise RequestError("Missing 'sequence' or 'sequences'.")
+
+        sequences = [sequence.split() if isinstance(sequence, str) else sequence for sequence in sequences]
+        if any(len(sequence) == 0 for sequence in sequences):
+            raise RequestError("Empty sequence.")
+
+        difficulties = await asyncio.gather(*[
+            self.difficulty(query["grammar"], model_name, query.get("max_depth"), {"sequence": sequence, **parameters})
+            for sequence in sequences
+        ])
+
+        # JSON has no infinity or NaN
+        difficulties = [difficulty if math.isfinite(difficulty) else None for difficulty in difficulties]
+        return {"difficulty": difficulties[0] if "sequence" in query else difficulties}
+
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                try:
+                    (method, path, _) = request_line.decode().split(" ", 2)
+                    headers = {}
+                    while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        (name, value) = line.decode().split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                    content_length = int(headers.get("content-length", 0))
+                except ValueError:
+                    # the rest of the stream cannot be trusted, so answer and close the connection
+                    await self._write_response(writer, "400 Bad Request", {"error": "Malformed request."})
+                    break
+
+                body = await reader.readexactly(content_length)
+                (status, response) = await self._respond(method, path, body)
+                await self._write_response(writer, status, response)
+
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+    async def _write_response(self, writer: asyncio.StreamWriter, status: str, response: dict):
+        content = json.dumps(response, allow_nan = False).encode()
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(content)}\r\n\r\n".encode()
+            + content
+        )
+        await writer.drain()
+
+
+    async def _respond(self, method: str, path: str, body: bytes) -> tuple[str, dict]:
+        if method == "GET" and path == "/health":
+            return ("200 OK", {"status": "ok"})
+
+        if method != "POST" or path != "/difficulty":
+            return ("404 Not Found", {"error": f"No route for {method} {path}."})
+
+        try:
+            return ("200 OK", await self._handle_query(json.loads(body)))
+        except (RequestError, ValueError, KeyError, TypeError) as e:
+            return ("400 Bad Request", {"error": str(e)})
+        except Exception as e:
+            return ("500 Internal Server Error", {"error": repr(e)})
+
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8765, unix_socket: str | None = None):
+        """Start listening on `host`:`port`, or on the Unix socket `unix_socket` if given."""
+        if unix_socket is not None:
+            self._server = await asyncio.start_unix_server(self._handle_connection, unix_socket)
+        else:
+            self._server = await asyncio.start_server(self._handle_connection, host, port)
+
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        self.executor.shutdown()
+
+
+    async def serve_forever(self):
+        async with self._server:
+            await self._server.serve_forever()
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description = "Serve processing difficulty queries over HTTP on a local port or Unix socket.")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 8765)
+    parser.add_argument("--unix-socket", default = None, help = "listen on this Unix socket instead of a port")
+    parser.add_argument("--processes", type = int, default = 1, help = "number of worker processes (0 evaluates in a background thread)")
+    parser.add_argument("--batch-window", type = float, default = 2.0, help = "milliseconds to collect concurrent requests for a batch")
+    parser.add_argument("--warm", action = "append", default = [], help = "grammar file to build a progressive noise model for on start-up")
+    args = parser.parse_args(argv)
+
+    warm = []
+    for filename in args.warm:
+        with open(filename, "r") as f:
+            warm.append((f.read(), "progressive", None))
+
+    async def _serve():
+        server = DifficultyServer(args.processes, args.batch_window / 1000, warm = warm)
+        await server.start(args.host, args.port, args.unix_socket)
+        try:
+            await server.serve_forever()
+        finally:
+            await server.close()
+
+    asyncio.run(_serve())
+
+
+if __name__ == "__main__":
+    main()
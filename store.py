@@ -0,0 +1,159 @@
+import json
+import os
+from typing import Callable, Iterator
+
+import numpy as np
+
+
+class ResultStore:
+    """
+    A memory-mapped on-disk array for the results of a parameter sweep, keeping track of
+    which cells have been computed.
+
+    The store is a directory holding `values.npy` (the results, `NaN` where not yet computed),
+    `done.npy` (whether each cell has been computed) and `axes.json` (the name and labels of
+    each axis). Both arrays are memory-mapped, so every result is on disk as soon as it is
+    stored: a sweep that is interrupted can be resumed with `ResultStore.open` and `run`,
+    which skips all cells already done, and other processes can open the same store with
+    `readonly = True` and slice the partial results while the sweep is running.
+
+    Use `ResultStore.open` rather than the constructor.
+
+    Args
+    ----
+    path : str
+        The directory of the store.
+    readonly : bool (default `False`)
+        Open the arrays read-only.
+    """
+    def __init__(self, path: str, readonly: bool = False):
+        self.path = path
+        mode = "r" if readonly else "r+"
+
+        with open(os.path.join(path, "axes.json"), "r") as f:
+            self.axes: dict[str, list] = json.load(f)
+
+        self.values = np.load(os.path.join(path, "values.npy"), mmap_mode = mode)
+        self.done = np.load(os.path.join(path, "done.npy"), mmap_mode = mode)
+
+
+    @classmethod
+    def open(cls, path: str, axes: dict[str, list] | None = None, readonly: bool = False) -> "ResultStore":
+        """
+        Open the store at `path`, creating it if it does not exist.
+
+        Args
+        ----
+        path : str
+            The directory of the store.
+        axes : dict[str, list] | None (default `None`)
+            The name and labels of each axis, in order, e.g.
+            `{"delta": list(deltas), "nu": list(nus), "item": ["RPNom V", "RPNom DO V"]}`.
+            Labels have to be JSON-serialisable. Required to create a new store; for an
+            existing one it has to match the axes it was created with.
+        readonly : bool (default `False`)
+            Open the arrays read-only.
+
+        Returns
+        -------
+        ResultStore
+            The store.
+        """
+        if axes is not None:
+            # numpy scalars (e.g. from `np.linspace`) are not JSON-serialisable, but the other labels
+            # are kept as they are rather than cast to a common type
+            axes = {
+                name: [label.item() if isinstance(label, np.generic) else label for label in labels]
+                for (name, labels) in axes.items()
+            }
+
+        if os.path.exists(os.path.join(path, "axes.json")):
+            store = cls(path, readonly)
+            if axes is not None and axes != store.axes:
+                raise ValueError(f"The store at '{path}' was created with different axes.")
+            return store
+
+        if axes is None:
+            raise ValueError(f"There is no store at '{path}' and no axes were given to create one.")
+
+        os.makedirs(path, exist_ok = True)
+        shape = tuple(len(labels) for labels in axes.values())
+
+        values = np.lib.format.open_memmap(os.path.join(path, "values.npy"), mode = "w+", dtype = np.float64, shape = shape)
+        values[...] = np.nan
+        values.flush()
+        done = np.lib.format.open_memmap(os.path.join(path, "done.npy"), mode = "w+", dtype = bool, shape = shape)
+        done.flush()
+        del values, done
+
+        # axes.json is written last, so a store is only ever opened once its arrays exist
+        with open(os.path.join(path, "axes.json"), "w") as f:
+            json.dump(axes, f)
+
+        return cls(path, readonly)
+
+
+    @property
+    def shape(self) -> tuple[int, ...]:
+        return self.values.shape
+
+
+    def __getitem__(self, index) -> np.ndarray:
+        """Slice the results, with `NaN` for cells not yet computed."""
+        return self.values[index]
+
+
+    def __setitem__(self, index, value):
+        """Store results and mark their cells as done."""
+        self.values[index] = value
+        self.done[index] = True
+
+
+    def pending(self) -> Iterator[tuple[int, ...]]:
+        """Iterate over the indices of all cells not yet computed."""
+        for index in np.argwhere(~self.done):
+            yield tuple(index.tolist())
+
+
+    def progress(self) -> float:
+        """Return the fraction of cells computed."""
+        return float(self.done.mean()) if self.done.size else 1.0
+
+
+    def labels(self, index: tuple[int, ...]) -> tuple:
+        """Return the axis labels of the cell at `index`."""
+        return tuple(labels[i] for (labels, i) in zip(self.axes.values(), index))
+
+
+    def run(self, function: Callable[..., float], flush_every: int = 100) -> int:
+        """
+        Compute all cells not yet done.
+
+        Args
+        ----
+        function : Callable[..., float]
+            Called with the axis labels of a cell as positional arguments, in the order
+            of the axes, returning the result for that cell.
+        flush_every : int (default `100`)
+            Flush the arrays to disk after this many cells.
+
+        Returns
+        -------
+        int
+            The number of cells computed.
+        """
+        n_computed = 0
+        for index in self.pending():
+            self[index] = function(*self.labels(index))
+            n_computed += 1
+            if n_computed % flush_every == 0:
+                self.flush()
+
+        self.flush()
+        return n_computed
+
+
+    def flush(self):
+        """Write the arrays to disk."""
+        self.values.flush()
+        self.done.flush()